@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+# PA6, CS124, Stanford, Winter 2019
+# v.1.0.3
+#
+# Usage:
+#   python benchmark.py ratings
+#   python benchmark.py ratings --rows 20000000
+#   python benchmark.py spell
+#   python benchmark.py sentiment --reviews 10000 --processes 4
+#   python benchmark.py neighbors --neighbors 10 25 50 100
+#   python benchmark.py batch --block-sizes 64 256 1024
+#   python benchmark.py blocked --block-sizes 256 1024 4096
+#   python benchmark.py factors --factors 16 32 64 128
+######################################################################
+import argparse
+import csv
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import chatbot
+import movielens
+from chatbot import Chatbot
+from deps import recommender
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def legacy_parse_ratings(src_filename, delimiter='%'):
+    """The original two-pass loader: count users with readlines(), then fill values with csv.reader."""
+    user_id_set = set()
+    with open(src_filename, 'r') as f:
+        for line in f.readlines():
+            user_id_set.add(int(line.split(delimiter)[0]))
+
+    user_ids, movie_ids, values = [], [], []
+    with open(src_filename) as f:
+        for line in csv.reader(f, delimiter=delimiter):
+            user_ids.append(int(line[0]))
+            movie_ids.append(int(line[1]))
+            values.append(float(line[2]))
+    return np.array(user_ids), np.array(movie_ids), np.array(values)
+
+def write_synthetic_ratings(path, num_rows, num_users=138000, num_movies=27000, seed=0):
+    """Write a MovieLens shaped ratings file with num_rows random ratings."""
+    rng = np.random.RandomState(seed)
+    block = 1000000
+    with open(path, 'w') as f:
+        for start in range(0, num_rows, block):
+            n = min(block, num_rows - start)
+            user_ids = np.sort(rng.randint(0, num_users, n))
+            movie_ids = rng.randint(0, num_movies, n)
+            values = rng.randint(1, 11, n) / 2
+            # savetxt joins the delimiter into its % format string, so it is escaped
+            np.savetxt(f, np.column_stack([user_ids, movie_ids, values]), fmt=['%d', '%d', '%f'], delimiter='%%')
+
+def benchmark_ratings(args):
+    src_filename = args.file
+    tmp_dir = None
+    if args.rows:
+        tmp_dir = tempfile.TemporaryDirectory()
+        src_filename = os.path.join(tmp_dir.name, 'ratings.txt')
+        print("Writing {} synthetic ratings to {}...".format(args.rows, src_filename))
+        write_synthetic_ratings(src_filename, args.rows)
+
+    print("Parsing {}".format(src_filename))
+    (user_ids, _, _), seconds = timed(movielens.parse_ratings, src_filename)
+    rows = len(user_ids)
+    print("  chunked parser: {:>10} rows in {:7.3f}s = {:>12,.0f} rows/sec".format(rows, seconds, rows / seconds))
+
+    if not args.skip_legacy:
+        (user_ids, _, _), seconds = timed(legacy_parse_ratings, src_filename)
+        print("  legacy parser:  {:>10} rows in {:7.3f}s = {:>12,.0f} rows/sec".format(rows, seconds, rows / seconds))
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+def misspell(title, rng, edits):
+    """Apply random character deletions, insertions and substitutions to title."""
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    for _ in range(edits):
+        pos = rng.randint(0, len(title))
+        edit = rng.randint(0, 3)
+        if edit == 0 and len(title) > 1:
+            title = title[:pos] + title[pos + 1:]
+        elif edit == 1:
+            title = title[:pos] + letters[rng.randint(0, 26)] + title[pos:]
+        else:
+            title = title[:pos] + letters[rng.randint(0, 26)] + title[pos + 1:]
+    return title
+
+def iter_bktree_nodes(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(node[2].values())
+
+def benchmark_spell(args):
+    bot = Chatbot(True)
+    rng = np.random.RandomState(args.seed)
+    queries = [misspell(bot.titles[i][0], rng, rng.randint(1, 3)) for i in rng.choice(len(bot.titles), args.queries, replace=False)]
+    print("Spell correcting {} misspelled titles with max_distance={}".format(len(queries), args.max_distance))
+
+    results = {}
+    for search in args.searches:
+        chatbot.SPELL_SEARCH = search
+        results[search], seconds = timed(lambda: [bot.find_movies_closest_to_title(q, args.max_distance) for q in queries])
+        print("  {:>6}: {:8.3f} ms/query".format(search, seconds / len(queries) * 1000))
+
+    num_nodes = sum(1 for _ in iter_bktree_nodes(bot.title_tree.root))
+    visited = [bot.title_tree.search(q.lower(), args.max_distance)[1] for q in queries]
+    print("  BK-tree visits {:.1f} of {} nodes per query ({:.1%})".format(np.mean(visited), num_nodes, np.mean(visited) / num_nodes))
+
+    for search in args.searches[1:]:
+        mismatches = sum(a != b for a, b in zip(results[args.searches[0]], results[search]))
+        print("  {} vs {}: {} mismatching results".format(search, args.searches[0], mismatches))
+
+def synthetic_reviews(bot, num_reviews, rng):
+    """Short reviews mixing lexicon words, negations, resets and filler words."""
+    words = list(bot.sentiment) + ['not', 'never', "didn't", 'but', 'however', 'the', 'movie', 'was', 'it.', 'really,']
+    return [' '.join(rng.choice(words, rng.randint(5, 30))) for _ in range(num_reviews)]
+
+def benchmark_sentiment(args):
+    bot = Chatbot(False)
+    reviews = synthetic_reviews(bot, args.reviews, np.random.RandomState(args.seed))
+    print("Scoring {} synthetic reviews".format(len(reviews)))
+
+    single, seconds = timed(lambda: [bot.extract_sentiment(review) for review in reviews])
+    print("  extract_sentiment:       {:8.3f}s = {:>10,.0f} reviews/sec".format(seconds, len(reviews) / seconds))
+    batch, seconds = timed(lambda: list(bot.extract_sentiment_batch(reviews, chunk_size=args.chunk_size)))
+    print("  extract_sentiment_batch: {:8.3f}s = {:>10,.0f} reviews/sec".format(seconds, len(reviews) / seconds))
+    print("  {} mismatching results".format(sum(a != b for a, b in zip(single, batch))))
+
+    if args.processes:
+        pooled, seconds = timed(lambda: list(bot.extract_sentiment_batch(reviews, chunk_size=args.chunk_size, processes=args.processes)))
+        print("  {} processes:             {:8.3f}s = {:>10,.0f} reviews/sec".format(args.processes, seconds, len(reviews) / seconds))
+        print("  {} mismatching results".format(sum(a != b for a, b in zip(single, pooled))))
+
+def sample_users(bot, num_users, rng):
+    """Binarized rating vectors of randomly chosen users from the ratings matrix."""
+    by_user = bot.ratings.T
+    users = rng.choice(by_user.shape[0], min(num_users, by_user.shape[0]), replace=False)
+    return [by_user[int(user)] for user in users]
+
+def benchmark_neighbors(args):
+    bot = Chatbot(False)
+    users = sample_users(bot, args.users, np.random.RandomState(args.seed))
+    neighbor_engine, _ = timed(bot.model.neighbor_engine)
+    print("Recommending top {} for {} users, neighbor table of {} per movie".format(
+        args.k, len(users), neighbor_engine.num_neighbors))
+
+    exact, seconds = timed(lambda: [bot.engine.recommend(user, args.k) for user in users])
+    print("  {:>9}: {:8.3f} ms/user".format('exact', seconds / len(users) * 1000))
+
+    for num_neighbors in args.neighbors:
+        approx, seconds = timed(lambda: [neighbor_engine.recommend(user, args.k, num_neighbors) for user in users])
+        overlap = np.mean([len(set(a) & set(e)) / args.k for a, e in zip(approx, exact)])
+        identical = np.mean([a == e for a, e in zip(approx, exact)])
+        # Mean distance between each exact recommendation's rank in both lists, missing ones count as rank k
+        displacement = np.mean([np.mean([abs(rank - (a.index(i) if i in a else args.k)) for rank, i in enumerate(e)])
+                                for a, e in zip(approx, exact)])
+        print("  {:>9}: {:8.3f} ms/user, overlap@{} {:6.1%}, identical {:6.1%}, mean rank displacement {:.2f}".format(
+            'top {}'.format(num_neighbors), seconds / len(users) * 1000, args.k, overlap, identical, displacement))
+
+def benchmark_batch(args):
+    bot = Chatbot(False)
+    by_user = bot.ratings.T
+    user_matrix = by_user[np.arange(args.users) % by_user.shape[0]]
+    print("Recommending top {} for {} users".format(args.k, user_matrix.shape[0]))
+
+    single, seconds = timed(lambda: [bot.recommend(user_matrix[u], bot.ratings, args.k) for u in range(user_matrix.shape[0])])
+    print("  {:>16}: {:8.3f}s = {:>8,.0f} users/sec".format('one at a time', seconds, user_matrix.shape[0] / seconds))
+
+    for block_size in args.block_sizes:
+        batch, seconds = timed(bot.recommend_batch, user_matrix, args.k, block_size=block_size)
+        mismatches = sum(row != expected for row, expected in zip(batch.tolist(), single))
+        print("  {:>16}: {:8.3f}s = {:>8,.0f} users/sec, {} mismatching users".format(
+            'block of {}'.format(block_size), seconds, user_matrix.shape[0] / seconds, mismatches))
+
+def timed_peak(function, *args):
+    """Like timed, also returning the peak memory traced while function ran."""
+    tracemalloc.start()
+    try:
+        result, seconds = timed(function, *args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+def benchmark_blocked(args):
+    bot = Chatbot(False)
+    users = sample_users(bot, args.users, np.random.RandomState(args.seed))
+    _, ratings = movielens.ratings(sparse=True)
+    print("Recommending top {} for {} users from the memory-mapped ratings, {:,} bytes".format(args.k, len(users), ratings.nbytes))
+
+    # The in-memory engine has to binarize and normalize the whole matrix first
+    engine, seconds, peak = timed_peak(lambda: recommender.ItemItemEngine(recommender.binarize(ratings)))
+    print("  {:>16}: {:8.3f} ms to load, peak {:>12,} bytes".format('in memory', seconds * 1000, peak))
+    exact, seconds, peak = timed_peak(lambda: [engine.recommend(user, args.k) for user in users])
+    print("  {:>16}: {:8.3f} ms/user, peak {:>12,} bytes".format('in memory', seconds / len(users) * 1000, peak))
+
+    for block_size in args.block_sizes:
+        blocked = recommender.BlockedEngine(ratings, block_size, threshold=2.5)
+        results, seconds, peak = timed_peak(lambda: [blocked.recommend(user, args.k) for user in users])
+        print("  {:>16}: {:8.3f} ms/user, peak {:>12,} bytes, {} mismatching users".format(
+            'block of {}'.format(block_size), seconds / len(users) * 1000, peak, sum(a != e for a, e in zip(results, exact))))
+
+def hold_out_likes(ratings, num_users, rng):
+    """Hide one liked movie of num_users random users from a binarized
+    (num_movies x num_users) CSRMatrix.
+
+    Returns (ratings without the hidden likes, users, hidden movies).
+    """
+    by_user = ratings.T
+    likes = np.bincount(by_user.row_ids(), weights=by_user.data > 0, minlength=by_user.shape[0])
+    # Users need another like left to recommend from
+    users = rng.choice(np.flatnonzero(likes >= 2), num_users, replace=False)
+    data = np.array(ratings.data)
+    movies = []
+    for user in users:
+        movie = rng.choice(np.flatnonzero(by_user[int(user)] > 0))
+        start, end = ratings.indptr[movie], ratings.indptr[movie + 1]
+        data[start + np.flatnonzero(ratings.indices[start:end] == user)] = 0
+        movies.append(movie)
+    return ratings.with_data(data), users, movies
+
+def evaluate_engine(engine, queries, hidden, k):
+    """Return (recommendations, ms/user, hit rate of the hidden movies in the top k)."""
+    recommendations, seconds = timed(lambda: [engine.recommend(query, k) for query in queries])
+    hit_rate = np.mean([movie in recs for movie, recs in zip(hidden, recommendations)])
+    return recommendations, seconds / len(queries) * 1000, hit_rate
+
+def benchmark_factors(args):
+    bot = Chatbot(False)
+    ratings, users, hidden = hold_out_likes(bot.ratings, args.users, np.random.RandomState(args.seed))
+    by_user = ratings.T
+    queries = [by_user[int(user)] for user in users]
+    print("Hiding one liked movie of {} users, hit rate of the hidden movie in the top {}".format(len(users), args.k))
+
+    engine = recommender.ItemItemEngine(ratings)
+    exact, ms_per_user, hit_rate = evaluate_engine(engine, queries, hidden, args.k)
+    print("  {:>12}: {:8.3f} ms/user, hit rate {:6.1%}, {:>10,} bytes".format(
+        'exact', ms_per_user, hit_rate, engine.normalized.nbytes))
+
+    for num_factors in args.factors:
+        factors, seconds = timed(recommender.build_movie_factors, ratings, num_factors)
+        engine = recommender.FactorEngine(factors)
+        results, ms_per_user, hit_rate = evaluate_engine(engine, queries, hidden, args.k)
+        overlap = np.mean([len(set(a) & set(e)) / args.k for a, e in zip(results, exact)])
+        print("  {:>12}: {:8.3f} ms/user, hit rate {:6.1%}, {:>10,} bytes, trained in {:.1f}s, overlap@{} with exact {:6.1%}".format(
+            '{} factors'.format(num_factors), ms_per_user, hit_rate, factors.nbytes, seconds, args.k, overlap))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the data loading and recommendation paths of the chatbot.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    ratings_parser = subparsers.add_parser('ratings', help='Rows/sec of the ratings file parser')
+    ratings_parser.add_argument('--file', default=movielens.RATINGS_FILE, help='Ratings file to parse')
+    ratings_parser.add_argument('--rows', type=int, default=0, help='Parse a synthetic file with this many rows instead')
+    ratings_parser.add_argument('--skip-legacy', action='store_true', help='Do not time the original two-pass parser')
+    ratings_parser.set_defaults(run=benchmark_ratings)
+
+    spell_parser = subparsers.add_parser('spell', help='Spell correction with the BK-tree and batch search against the linear scan')
+    spell_parser.add_argument('--queries', type=int, default=20, help='Number of misspelled titles')
+    spell_parser.add_argument('--max-distance', type=int, default=chatbot.EDIT_DIST)
+    spell_parser.add_argument('--searches', nargs='+', default=['scan', 'bktree', 'batch'], help='SPELL_SEARCH values to time, the first is the reference')
+    spell_parser.add_argument('--seed', type=int, default=0)
+    spell_parser.set_defaults(run=benchmark_spell)
+
+    sentiment_parser = subparsers.add_parser('sentiment', help='Review scoring one at a time against extract_sentiment_batch')
+    sentiment_parser.add_argument('--reviews', type=int, default=5000, help='Number of synthetic reviews')
+    sentiment_parser.add_argument('--chunk-size', type=int, default=chatbot.SENTIMENT_CHUNK_SIZE)
+    sentiment_parser.add_argument('--processes', type=int, default=0, help='Also time scoring with a pool of this many processes')
+    sentiment_parser.add_argument('--seed', type=int, default=0)
+    sentiment_parser.set_defaults(run=benchmark_sentiment)
+
+    neighbors_parser = subparsers.add_parser('neighbors', help='Neighbor table recommendations against the exact item-item engine')
+    neighbors_parser.add_argument('--users', type=int, default=200, help='Number of users from the ratings matrix')
+    neighbors_parser.add_argument('--neighbors', type=int, nargs='+', default=[10, 25, 50, 100], help='Neighbors per rated movie to try')
+    neighbors_parser.add_argument('--k', type=int, default=chatbot.NUM_REC, help='Recommendations per user')
+    neighbors_parser.add_argument('--seed', type=int, default=0)
+    neighbors_parser.set_defaults(run=benchmark_neighbors)
+
+    batch_parser = subparsers.add_parser('batch', help='recommend_batch against recommending one user at a time')
+    batch_parser.add_argument('--users', type=int, default=2000, help='Number of users, cycling through the ratings matrix')
+    batch_parser.add_argument('--block-sizes', type=int, nargs='+', default=[64, 256, 1024], help='Block sizes to time')
+    batch_parser.add_argument('--k', type=int, default=chatbot.NUM_REC, help='Recommendations per user')
+    batch_parser.set_defaults(run=benchmark_batch)
+
+    blocked_parser = subparsers.add_parser('blocked', help='Recommendations streamed from the memory-mapped ratings against the in-memory engine')
+    blocked_parser.add_argument('--users', type=int, default=50, help='Number of users from the ratings matrix')
+    blocked_parser.add_argument('--block-sizes', type=int, nargs='+', default=[256, 1024, 4096], help='Block sizes to time')
+    blocked_parser.add_argument('--k', type=int, default=chatbot.NUM_REC, help='Recommendations per user')
+    blocked_parser.add_argument('--seed', type=int, default=0)
+    blocked_parser.set_defaults(run=benchmark_blocked)
+
+    factors_parser = subparsers.add_parser('factors', help='Accuracy and latency of the factors engine against the exact item-item engine')
+    factors_parser.add_argument('--users', type=int, default=300, help='Number of users with a hidden liked movie')
+    factors_parser.add_argument('--factors', type=int, nargs='+', default=[16, 32, 64, 128], help='Latent factors per movie to try')
+    factors_parser.add_argument('--k', type=int, default=chatbot.NUM_REC, help='Recommendations per user')
+    factors_parser.add_argument('--seed', type=int, default=0)
+    factors_parser.set_defaults(run=benchmark_factors)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
@@ -12,20 +12,53 @@ use_multiple_movies_sentiment_extraction = False
 use_arbitrary_input_response = False
 use_understand_previous_references = False
 
-import movielens
+from model import MovieModel
 
+import collections
+import multiprocessing
 import numpy as np
 import re
 import random
 
 from deps import lib
+from deps import recommender
+from deps import sparse
 
 # Edit distance allowed for a movie title match
 EDIT_DIST = 3
 
-# Number of recommendations Marvin will suggest
+# How spell correction searches the catalogue: 'bktree' walks a BK-tree of the
+# titles, 'batch' computes the edit distance to every title at once with numpy,
+# 'scan' computes a bounded edit distance to every title one by one
+SPELL_SEARCH = 'bktree'
+
+# How recommendations are scored: 'exact' scores the whole catalogue with the
+# item-item engine, 'neighbors' only gathers scores from the precomputed
+# nearest neighbors of the rated movies, see movielens.neighbor_table,
+# 'factors' predicts ratings from latent movie factors, see movielens.movie_factors,
+# and 'blocked' scores like 'exact' but streams the memory-mapped ratings cache
+# block by block instead of keeping a normalized copy of the ratings in memory
+RECOMMEND_ENGINES = ('exact', 'neighbors', 'factors', 'blocked')
+RECOMMEND_ENGINE = 'exact'
+
+# Neighbors of each rated movie used by the 'neighbors' engine, None for all
+# the table holds. Fewer is faster but can miss good recommendations.
+RECOMMEND_NEIGHBORS = None
+
+# Number of recommendations Marvin selects at a time. More pages are selected
+# as long as the user keeps asking for another recommendation.
 NUM_REC = 10
 
+# Number of users recommend_batch scores together. Memory grows with
+# RECOMMEND_BLOCK_SIZE x the number of movies.
+RECOMMEND_BLOCK_SIZE = 256
+
+# Number of reviews extract_sentiment_batch scores together
+SENTIMENT_CHUNK_SIZE = 1000
+
+# Chunks extract_sentiment_batch keeps in flight for each worker process
+SENTIMENT_CHUNKS_PER_PROCESS = 2
+
 # Corpuses for different responses
 # Opening greeting
 greeting_corp = [
@@ -108,67 +141,130 @@ else:
             for line in spell_corrected_corp]
 
 
-class Chatbot:
-    """Simple class to implement the chatbot for PA 6."""
+# The chatbot used by extract_sentiment_batch worker processes
+sentiment_worker_bot = None
 
-    def __init__(self, creative=False):
-      # The chatbot's default name is `moviebot`. Give your chatbot a new name.
-      self.name = 'Marvin the Marvelous Moviebot'
+def init_sentiment_worker(bot):
+    global sentiment_worker_bot
+    sentiment_worker_bot = bot
 
-      self.creative = creative
+def score_sentiment_chunk(texts):
+    return sentiment_worker_bot.score_sentiment_chunk(texts)
 
-      # This matrix has the following shape: num_movies x num_users
-      # The values stored in each row i and column j is the rating for
-      # movie i by user j
-      self.titles, ratings = movielens.ratings()
-      self.titles = lib.standardize_titles(self.titles)
 
-      self.sentiment = movielens.sentiment()
-      self.sentiment = lib.stem_map(self.sentiment)
+class Session:
+    """The state of one conversation with the chatbot.
 
-      # Binarize the movie ratings before storing the binarized matrix.
-      self.ratings = self.binarize(ratings)
+    Only what a conversation changes lives here; the titles, ratings and
+    lexicon it reads are in the shared model.MovieModel. Until the exact
+    engine scores it, a session holds one byte per movie besides a few flags,
+    so a single chatbot can keep thousands of them.
+    """
 
+    __slots__ = (
       # Vector that keeps track of user movie preference
-      self.user_ratings = np.zeros(len(self.titles))
-
-      # Flag that user can update by talking to the chatbot. Set to false when the user asks for a recommendation
-      # self.add_review = True
-
+      'user_ratings',
+      # Running item-item score of every movie for user_ratings, and the
+      # ratings it was last brought up to date with, see Chatbot.update_scores.
+      # Both are None until the first update.
+      'scores', 'scored_ratings',
       # Becomes true once the user's made 5 recommendations.
-      self.can_recommend = False
-
+      'can_recommend',
       # Flag for if quoteless movie title extraction was performed
-      self.quoteless_title_extraction = False
-
+      'quoteless_title_extraction',
       # Used when Marvin asks if the user wants to accept the spell correction or not
       # Variables for remembering info about the movie that's being spell corrected.
+      'spell_correction_answer', 'spell_correction_prompt', 'spell_correction_movie_index',
+      'spell_correction_movie_title', 'spell_correction_review',
+      # Used when Marvin cannot determine if a review is pos or neg and asks for more information
+      # Variables for remembering info about the movie that's going to have its preference updated
+      'preference_update_answer', 'preference_update_movie_index', 'preference_update_movie_title',
+      # Used when Marvin finds multiple movies that match the description and needs to disambiguate
+      # Variables for remembering info about the movies that need clarification
+      'clarify_answer', 'clarify_movie_indices', 'clarify_review',
+      # Used to keep track of recommendations
+      'rec_answer', 'rec_cursor',
+      # Used to keep track of the sentiment classification of the last review
+      'last_senti',
+    )
+
+    def __init__(self, num_movies):
+      # Ratings are only ever -1, 0 or 1
+      self.user_ratings = np.zeros(num_movies, dtype=np.int8)
+      self.scores = self.scored_ratings = None
+      self.can_recommend = False
+      self.quoteless_title_extraction = False
+
       self.spell_correction_answer = False
       self.spell_correction_prompt = ''
       self.spell_correction_movie_index = 0
       self.spell_correction_movie_title = ''
       self.spell_correction_review = ''
 
-      # Used when Marvin cannot determine if a review is pos or neg and asks for more information
-      # Variables for remembering info about the movie that's going to have its preference updated
       self.preference_update_answer = False
       self.preference_update_movie_index = 0
       self.preference_update_movie_title = 0
 
-      # Used when Marvin finds multiple movies that match the description and needs to disambiguate
-      # Variables for remembering info about the movies that need clarification
       self.clarify_answer = False
-      self.clarify_movie_indicies = []
+      self.clarify_movie_indices = []
       self.clarify_review = ''
 
-      # Used to keep track of recommendations
       self.rec_answer = False
-      self.recommendations = []
-      self.rec_index = 0
+      self.rec_cursor = None
 
-      # Used to keep track of the sentiment classification of the last review
       self.last_senti = 0
 
+    def __repr__(self):
+      return '<Session with {} rated movies>'.format(np.count_nonzero(self.user_ratings))
+
+def session_property(name):
+    """A Chatbot attribute that reads and writes the chatbot's own session."""
+    return property(lambda bot: getattr(bot.session, name),
+                    lambda bot, value: setattr(bot.session, name, value))
+
+
+class Chatbot:
+    """Simple class to implement the chatbot for PA 6."""
+
+    def __init__(self, creative=False, model=None):
+      # The chatbot's default name is `moviebot`. Give your chatbot a new name.
+      self.name = 'Marvin the Marvelous Moviebot'
+
+      self.creative = creative
+
+      # Titles, ratings and the sentiment lexicon are read-only and shared by
+      # every chatbot in the process, see model.MovieModel
+      if model is None:
+        model = MovieModel.shared(exact=RECOMMEND_ENGINE != 'blocked')
+      self.model = model
+      self.titles = self.model.titles
+      self.title_index = self.model.title_index
+      self.title_tree = self.model.title_tree
+      self.title_array = self.model.title_array
+      self.title_matcher = self.model.title_matcher
+      self.sentiment = self.model.sentiment
+      self.sentiment_lexicon = self.model.sentiment_lexicon
+
+      # The conversation with the REPL user. Other conversations pass their own
+      # Session to process_session.
+      self.session = self.new_session()
+
+    @property
+    def ratings(self):
+      """The binarized ratings, read from the model on each access since
+      share() and close() replace them, and so a pickled chatbot carries
+      them only through the model's own __getstate__."""
+      return self.model.ratings
+
+    @property
+    def engine(self):
+      """The item-item engine over the ratings, read from the model like ratings."""
+      return self.model.engine
+
+    def new_session(self):
+      """Return the state of a new conversation with this chatbot."""
+      return Session(self.model.num_movies)
+
     #############################################################################
     # 1. WARM UP REPL                                                           #
     #############################################################################
@@ -206,128 +302,157 @@ class Chatbot:
       :param line: a user-supplied line of text
       :returns: a string containing the chatbot's response to the user input
       """
+      return self.process_session(self.session, line)
+
+    def process_session(self, session, line):
+      """Process a line of input from one conversation and generate a response.
+
+      Same as process, but reads and updates the given Session instead of
+      the chatbot's own, so one chatbot can hold many conversations at once.
+
+      :param session: the Session of the conversation the line belongs to
+      :param line: a user-supplied line of text
+      :returns: a string containing the chatbot's response to the user input
+      """
+      # Every stage below reads the line's titles and stems from here
+      line = self.analyze(line)
+
       # Handle spell correction response first.
-      if self.creative and self.spell_correction_answer:
-        self.spell_correction_answer = False
-        response = self.process_spell_correction_response(line)
+      if self.creative and session.spell_correction_answer:
+        session.spell_correction_answer = False
+        response = self.process_spell_correction_response(line, session=session)
 
       # Handle user response to update movie preference first.
       # User is allowed to answer No and this part of the code will not execute
-      elif self.creative and self.preference_update_answer:
-          if line[:2].lower() != 'no':
-              senti = self.extract_sentiment(line)
-              response = self.process_movie_preference(self.preference_update_movie_index, self.preference_update_movie_title, review=None, usr_senti=senti)
+      elif self.creative and session.preference_update_answer:
+          if line.lower[:2] != 'no':
+              senti = self.extract_sentiment(line, session=session)
+              response = self.process_movie_preference(session.preference_update_movie_index, session.preference_update_movie_title, review=None, usr_senti=senti, session=session)
           else:
               response = "Ok, that's fine. Let's move on. Tell me something else."
-          self.preference_update_answer = False
+          session.preference_update_answer = False
 
       # Handle user response to disambiguate which movie the user is refering to
       # User is allowed to answer No and this part will not execute
-      elif self.creative and self.clarify_answer and disambiguate_extracted_titles:
-          if line[:2].lower() != 'no':
+      elif self.creative and session.clarify_answer and disambiguate_extracted_titles:
+          if line.lower[:2] != 'no':
               # Disambiguate if the user didn't say no
-              self.clarify_movie_indices = self.disambiguate(line, self.clarify_movie_indices)
-              movies = lib.extract_movies_using_indices(self.titles, self.clarify_movie_indices)
+              session.clarify_movie_indices = self.disambiguate(line.text, session.clarify_movie_indices)
+              movies = lib.extract_movies_using_indices(self.titles, session.clarify_movie_indices)
 
               # If we successfully identified one movie, add its review, otherwise keep asking for clarifications.
-              if len(self.clarify_movie_indices) == 1:
-                  response = self.process_movie_preference(self.clarify_movie_indices[0], movies[0], self.clarify_review)
-                  self.clarify_answer = False
+              if len(session.clarify_movie_indices) == 1:
+                  response = self.process_movie_preference(session.clarify_movie_indices[0], movies[0], session.clarify_review, session=session)
+                  session.clarify_answer = False
               else:
                   response = 'Thank you for clarifying! However, I still need to decide between {}. \nHelp me out? It\'s ok to say no.'.format(', '.join(movies))
           else:
               response = "Alrighty. Forget about that movie. Tell me another one."
-              self.clarify_answer = False
+              session.clarify_answer = False
 
       # Hanldes when the user wants another recommendation
-      elif self.rec_answer:
-        if 'yes' in line.lower():
-            if self.rec_index >= NUM_REC:
-                response = "Welp, I already gave you {} recommendations and now I'm out. Tell me more about movies so I can continue to recommend.".format(NUM_REC)
-                self.rec_answer = False
+      elif session.rec_answer:
+        if 'yes' in line.lower:
+            rec_index = session.rec_cursor.next()
+            if rec_index is None:
+                response = "Welp, I already gave you {} recommendations and now I'm out. Tell me more about movies so I can continue to recommend.".format(session.rec_cursor.count)
+                session.rec_answer = False
             else:
-                response = "May I recommend {}.".format(self.recommendations[self.rec_index]) + "\nDo you want another recommendation?"
-                self.rec_index += 1
-        elif 'no' in line.lower():
+                response = "May I recommend {}.".format(lib.extract_movies_using_indices(self.titles, [rec_index])[0]) + "\nDo you want another recommendation?"
+        elif 'no' in line.lower:
             response = "Ok, moving on. Feel free to add more reviews so I can make better recommendations."
-            self.rec_answer = False
+            session.rec_answer = False
         else:
             response = "Humm...so is that yes or no?"
 
       # Check if a user wants a recommendation:
-      elif self.can_recommend and "recommend" in line.lower():
+      elif session.can_recommend and "recommend" in line.lower:
         # Recommend movie(s).
         response = "I have found a recommendation for you: \n"
-        rec_indices = self.recommend(self.user_ratings, self.ratings, k=NUM_REC, creative=self.creative)
-        recs = lib.extract_movies_using_indices(self.titles, rec_indices)
-        self.recommendations = recs
-        self.rec_index = 1
-        self.rec_answer = True
-        response += recs[0] + '\nIf you would like to hear another recommendation, say yes, otherwise say no.'
-
-      elif "recommend" in line.lower():
+        session.rec_cursor = self.recommendation_cursor(session)
+        rec_index = session.rec_cursor.next()
+        session.rec_answer = True
+        response += lib.extract_movies_using_indices(self.titles, [rec_index])[0] + '\nIf you would like to hear another recommendation, say yes, otherwise say no.'
+
+      elif "recommend" in line.lower:
         # Not enough information to recommend a movie.
         return "You need to rate at least 5 movies before I can recommend anything. So what did you like or didn't like?"
 
       else:
-        response = self.add_movie_ratings(line)
+        response = self.add_movie_ratings(line, session=session)
 
       # Check if a user can have a recommendation
-      if np.count_nonzero(self.user_ratings) >= 5 and not self.can_recommend:
-          self.can_recommend = True
+      if np.count_nonzero(session.user_ratings) >= 5 and not session.can_recommend:
+          session.can_recommend = True
           return response + "\nGreat! Now I have enough information to make recommendations.\n You can continue to rate movies or ask for a recommendation."
 
       return response
 
-    def process_spell_correction_response(self, line):
+    def analyze(self, line):
+      """
+      Wraps a line of user input in a lib.Utterance, which caches its lowercased
+      text, titles and stemmed words. Lines that are already analyzed are returned as is.
+      """
+      if isinstance(line, lib.Utterance):
+        return line
+      return lib.Utterance(line)
+
+    def process_spell_correction_response(self, line, session=None):
       """
       Handles the user's response to a movie-title spelling correction confirmation.
       """
+      session = self.session if session is None else session
+      line = self.analyze(line)
+
       # Check if responding to a previous spell correction question.
-      has_y = 'y' in line.lower()
-      has_n = 'n' in line.lower()
+      has_y = 'y' in line.lower
+      has_n = 'n' in line.lower
 
       if has_y and not has_n:
         # Yes
         return self.process_movie_preference (
-          self.spell_correction_movie_index,
-          self.spell_correction_movie_title,
-          self.spell_correction_review
+          session.spell_correction_movie_index,
+          session.spell_correction_movie_title,
+          session.spell_correction_review,
+          session=session
         )
       elif has_n and not has_y:
         return lib.getResponse(
           spell_corrected_corp_single_no
-          ).format(self.spell_correction_movie_title)
+          ).format(session.spell_correction_movie_title)
         # No
       else:
         # Unknown
-        self.spell_correction_answer = True
+        session.spell_correction_answer = True
         return lib.getResponse(
           spell_corrected_corp_single_error
-          ).format(self.spell_correction_prompt)
+          ).format(session.spell_correction_prompt)
 
 
-    def add_movie_ratings(self, line):
+    def add_movie_ratings(self, line, session=None):
       """
       Takes in a user input in the form of a movie review.
       Returns a response in the form of a string. The response either reprompts the user or
       confirms the review is received.
       (starter mode) Extracts only one movie.
       """
+      session = self.session if session is None else session
+      line = self.analyze(line)
+
       # Extract titles from user input.
-      titles = self.extract_titles(line)
+      titles = self.extract_titles(line, session=session)
 
       ### No titles are extracted ###
       if len(titles) == 0:
         if use_arbitrary_input_response and self.creative:
           # parse input and see if we can generate some arbitrary response
-          return self.generate_arbitrary_response(line)
+          return self.generate_arbitrary_response(line.text)
         else:
           return "I didn't catch that. Did you talk about exactly one movie? Remember to put the movie title in quotes."
 
       ### More than one title is extracted ###
       elif len(titles) > 1:
-        if self.quoteless_title_extraction:
+        if session.quoteless_title_extraction:
             return ("Sorry, I didn't quite catch that. " +
                 "I can only process a single quoteless title currently, and I think you might've mentioned " +
                 "{}.\nPlease try encolosing your movie".format(lib.concatenate_titles(
@@ -335,19 +460,22 @@ class Chatbot:
                 ) +
                 " titles with \"\" or talking only about a single movie.")
         elif use_multiple_movies_sentiment_extraction and self.creative:
-            return self.process_multi_titles(line)
+            return self.process_multi_titles(line, session=session)
         else:
             return "I didn't catch that. Did you talk about exactly one movie? Remember to put the movie title in quotes."
 
       ### Exactly one title extracted ###
       else:
         title = titles[0]
-        return self.process_single_title(title, line)
+        return self.process_single_title(title, line, session=session)
 
     def generate_arbitrary_response(self, line):
       """
       Generates some arbitrary response depending on user input
       """
+      if isinstance(line, lib.Utterance):
+        line = line.text
+
       if len (re.split(r'\? |! |\. ', line)) > 1:
         # Too many sentences
         return "Woah there, slow down! I can only understand one sentence at a time."
@@ -418,12 +546,13 @@ class Chatbot:
         return ("{} But why don't we try talking more about movies?".format(lib.getResponse(catchall_corp))
         + " After all, I am Marvin the Marvelous 'Movie' bot :)")
 
-    def process_multi_titles(self, line):
+    def process_multi_titles(self, line, session=None):
       """
       Used by add_movie_ratings when many movies titles are found
       Handles the case where the user supplies multiple movie titles.
       """
-      movie_sentiments = self.extract_sentiment_for_movies(line)
+      session = self.session if session is None else session
+      movie_sentiments = self.extract_sentiment_for_movies(self.analyze(line).text, session=session)
       pos_titles = []
       neg_titles = []
       neutral_titles = []
@@ -431,17 +560,17 @@ class Chatbot:
 
       for elem in movie_sentiments:
         movie_title, sentiment = elem
-        movie_indexes = self.find_movies_by_title(movie_title)
+        movie_indexes = self.find_movies_by_title(movie_title, session=session)
         title = '\"' + movie_title + '\"'
 
         if len(movie_indexes) == 1:
-          self.process_movie_preference(movie_indexes[0], movie_title, None, sentiment)
+          self.process_movie_preference(movie_indexes[0], movie_title, None, sentiment, session=session)
 
           if sentiment < 0:
             neg_titles.append(title)
           elif sentiment == 0:
             # TODO Currently does not support multiple movies preference update(if one is neutral)
-            self.preference_update_answer = False
+            session.preference_update_answer = False
             neutral_titles.append(title)
           else:
             pos_titles.append(title)
@@ -475,18 +604,19 @@ class Chatbot:
 
       return response
 
-    def process_single_title(self, title, line):
+    def process_single_title(self, title, line, session=None):
       """
       Used by add_movie_ratings when exactly one movie title is found
       Handles the case where the user supplies multiple movie titles.
       """
+      session = self.session if session is None else session
       # Search for a matching movie.
-      movie_index = self.find_movies_by_title(title)
+      movie_index = self.find_movies_by_title(title, session=session)
       spell_corrected = False
 
       # Try enabling spell correction if no movies were found.
       if use_title_spell_correction and self.creative and len (movie_index) == 0:
-        movie_index = self.find_movies_closest_to_title(title)
+        movie_index = self.find_movies_closest_to_title(title, session=session)
         spell_corrected = True
 
       movies = [('\"' + m + '\"') for m in lib.extract_movies_using_indices(self.titles, movie_index)]
@@ -497,23 +627,23 @@ class Chatbot:
 
       # One movie is found with spell correction
       elif len(movies) == 1 and spell_corrected:
-          self.spell_correction_answer = True
-          self.spell_correction_prompt = lib.getResponse(
+          session.spell_correction_answer = True
+          session.spell_correction_prompt = lib.getResponse(
             spell_corrected_corp_single).format(title, movies[0])
-          self.spell_correction_movie_index = movie_index[0]
-          self.spell_correction_movie_title = movies[0]
-          self.spell_correction_review = line
+          session.spell_correction_movie_index = movie_index[0]
+          session.spell_correction_movie_title = movies[0]
+          session.spell_correction_review = line
 
-          return self.spell_correction_prompt
+          return session.spell_correction_prompt
 
       # More than one movie is found
       elif len(movies) > 1:
 
         if disambiguate_extracted_titles:
           # Prepare for clarifications from user
-          self.clarify_answer = True
-          self.clarify_movie_indices = movie_index
-          self.clarify_review = line
+          session.clarify_answer = True
+          session.clarify_movie_indices = movie_index
+          session.clarify_review = line
 
         # Build movies list with correct grammar. Final conjunction depends on case.
         if spell_corrected:
@@ -524,36 +654,39 @@ class Chatbot:
           return lib.getResponse(multi_movie_corp).format(title, formatted_movies)
 
       # Exactly one movie is found
-      return self.process_movie_preference(movie_index[0], movies[0], line)
+      return self.process_movie_preference(movie_index[0], movies[0], line, session=session)
 
 
-    def process_movie_preference (self, movie_index, movie_title, review, usr_senti=None):
+    def process_movie_preference (self, movie_index, movie_title, review, usr_senti=None, session=None):
       """ Performs sentiment extraction on the user's review and updates the
       user_rating for the specified movie. Returns the bot's response to the
       user as implicit confirmation.
       """
+      session = self.session if session is None else session
       if usr_senti is None:
-        sentiment = self.extract_sentiment(review)
+        sentiment = self.extract_sentiment(review, session=session)
       else:
         sentiment = usr_senti
 
       # Provide ackowledgement
       if sentiment == 1:
-        self.user_ratings[movie_index] = 1
+        session.user_ratings[movie_index] = 1
+        self.update_scores(session)
         return lib.getResponse(pos_movie_corp).format(movie_title)
 
       elif sentiment == 0:
-        self.preference_update_answer = True
-        self.preference_update_movie_title = movie_title
-        self.preference_update_movie_index = movie_index
+        session.preference_update_answer = True
+        session.preference_update_movie_title = movie_title
+        session.preference_update_movie_index = movie_index
         return lib.getResponse(neutral_movie_corp).format(movie_title)
 
       else:
-        self.user_ratings[movie_index] = -1
+        session.user_ratings[movie_index] = -1
+        self.update_scores(session)
         return lib.getResponse(neg_movie_corp).format(movie_title)
 
 
-    def extract_titles(self, text):
+    def extract_titles(self, text, session=None):
       """Extract potential movie titles from a line of text.
 
       Given an input text, this method should return a list of movie titles
@@ -572,6 +705,19 @@ class Chatbot:
       :param text: a user-supplied line of text that may contain movie titles
       :returns: list of movie titles that are potentially in the text
       """
+      session = self.session if session is None else session
+      utterance = self.analyze(text)
+      if utterance.titles is None:
+        utterance.titles, utterance.quoteless = self.scan_titles(utterance)
+      session.quoteless_title_extraction = utterance.quoteless
+      return list(utterance.titles)
+
+    def scan_titles(self, utterance):
+      """
+      Does the work of extract_titles for an utterance that was not scanned yet.
+      Returns the titles and whether they were found without quotation marks.
+      """
+      text = utterance.text
       titles = []
 
       quote_pat = '\"(?P<title>[^\"]+)\"'
@@ -579,17 +725,19 @@ class Chatbot:
       for title in e_matches:
         titles.append(title)
 
-      self.quoteless_title_extraction = False
+      quoteless = False
       if use_quoteless_caseless_extraction and self.creative and len(titles) == 0:
-        # Attempt to extract titles without explicit quotation marks
-        for elem in self.titles:
-          title, year, _ = elem
+        # Attempt to extract titles without explicit quotation marks.
+        # Only titles whose words all appear in the text can match.
+        text_lower = utterance.lower
+        for i in self.title_matcher.candidates(text_lower):
+          title, year, _ = self.titles[i]
           title_with_year = title + ' ({})'.format(year)
 
-          if lib.extract_title_by_word(title_with_year.lower(), text.lower()):
+          if lib.extract_title_by_word(title_with_year.lower(), text_lower):
             # Title and year together are unique identifiers of a movie
-            return [title_with_year,]
-          elif lib.extract_title_by_word(title.lower(), text.lower()):
+            return [title_with_year,], False
+          elif lib.extract_title_by_word(title.lower(), text_lower):
             # Remove existing titles that are substrings of current title
             titles_to_remove = []
             for t in titles:
@@ -607,11 +755,11 @@ class Chatbot:
               titles.append(title)
 
         if len(titles) > 0:
-          self.quoteless_title_extraction = True
+          quoteless = True
 
-      return titles
+      return titles, quoteless
 
-    def find_movies_by_title(self, title, max_distance=-1):
+    def find_movies_by_title(self, title, max_distance=-1, session=None):
       """ Given a movie title, return a list of indices of matching movies.
 
       - If no movies are found that match the given title, return an empty list.
@@ -630,6 +778,7 @@ class Chatbot:
       :param title: a string containing a movie title
       :returns: a list of indices of matching movies
       """
+      session = self.session if session is None else session
       movies = []
 
       movie_title = title
@@ -644,8 +793,40 @@ class Chatbot:
       # Standardize leading article position (move to front)
       movie_title = lib.move_leading_article_to_front(movie_title)
 
-      # Search through movie title database for matching titles
-      for i in range(len(self.titles)):
+      # Spell correction only visits the part of the BK-tree within max_distance
+      if max_distance > 0 and SPELL_SEARCH == 'bktree':
+          accept = None
+          if movie_year is not None:
+              accept = lambda i: self.titles[i][1] == movie_year
+          movies, _ = self.title_tree.search(movie_title.lower(), max_distance, accept)
+          return movies
+
+      # Batched spell correction scores the whole catalogue (or year) in numpy
+      if max_distance > 0 and SPELL_SEARCH == 'batch':
+          candidates = np.arange(len(self.titles))
+          if movie_year is not None:
+              candidates = np.array(self.title_index.year(movie_year), dtype=int)
+          distances = lib.edit_distances(movie_title.lower(), self.title_array[candidates], max_distance)
+          if len(distances) == 0 or distances.min() > max_distance:
+              return []
+          return candidates[distances == distances.min()].tolist()
+
+      # Use the title index to only visit entries that can match
+      candidates = None
+      if max_distance <= 0:
+          if not self.creative:
+              candidates = self.title_index.exact(movie_title)
+          elif session.quoteless_title_extraction:
+              candidates = self.title_index.exact_lower(movie_title)
+          else:
+              candidates = self.title_index.containing_words(movie_title)
+              if candidates is not None:
+                  candidates = sorted(set(candidates).union(self.title_index.exact_lower(movie_title)))
+      if candidates is None:
+          candidates = self.title_index.year(movie_year) if movie_year is not None else range(len(self.titles))
+
+      # Search through the candidate titles for matching titles
+      for i in candidates:
         entry_title, entry_year, genre = self.titles[i]
 
         # Filter by movie year
@@ -659,7 +840,7 @@ class Chatbot:
               # Handle differing capitalizations
               # If user inputs "scream", should find all movies containing "scream" but not "screams" / "screaming"
               # Only if movie was found using quotes, otherwise just use lower case comparison to reduce overflowing matches
-              if lib.title_contains_words(movie_title, entry_title) and not self.quoteless_title_extraction:
+              if lib.title_contains_words(movie_title, entry_title) and not session.quoteless_title_extraction:
                   movies.append(i)
               elif movie_title.lower() == entry_title.lower():
                   movies.append(i)
@@ -667,8 +848,9 @@ class Chatbot:
               if movie_title == entry_title:
                   movies.append(i)
         else:
-            dist = lib.min_edit_distance(movie_title.lower(), entry_title.lower())
-            if dist <= max_distance:
+            # Titles further than the closest one so far are dropped anyway
+            dist = lib.min_edit_distance(movie_title.lower(), entry_title.lower(), min_dist)
+            if dist <= min_dist:
                 movies.append((dist, i))
                 min_dist = min(min_dist, dist)
 
@@ -683,7 +865,7 @@ class Chatbot:
       return movies
 
 
-    def extract_sentiment(self, text):
+    def extract_sentiment(self, text, session=None):
       """Extract a sentiment rating from a line of text.
 
       You should return -1 if the sentiment of the text is negative, 0 if the
@@ -700,50 +882,26 @@ class Chatbot:
       :param text: a user-supplied line of text
       :returns: a numerical value for the sentiment of the text
       """
+      session = self.session if session is None else session
       # Naive implementation of just counting positive words vs negative words
-      negations = ['don\'t', 'not', 'never', 'none', 'nothing', 'hardly', 'didn\'t', 'no']
-      negation_scale = 1
-
-      resets = ['but', 'however']
-
-      # Remove movie names from the text
-      text = text.lower()
-      titles = self.extract_titles(text)
-      for title in titles:
-        text = text.replace(title.lower(), '')
-
-      words_stemmed = lib.stem_text(text)
-      words = words_stemmed.split()
-      posCount = 0
-      #print(words)
-      for word in words:
-          # All words after the negation will take on its inverted value
-          if word in negations:
-              negation_scale *= -1
-          # Whatever comes before reset words don't really matter
-          elif word in resets:
-              posCount = 0
-
-          # Reset the negation scale to 1 if at end punctuation. Commas don't count.
-          if not word[len(word) - 1].isalpha() and word[len(word) - 1] != ",":
-              negation_scale = 1
-
-          if word in self.sentiment:
-              if self.sentiment[word] == 'pos':
-                  #print("Word: " + word + " score: " + str(negation_scale))
-                  posCount += negation_scale
-              else:
-                  #print("Word: " + word + " score: " + str(-negation_scale))
-                  posCount -= negation_scale
+      # Words after a negation take on the inverted value until the end of the sentence,
+      # and whatever comes before 'but' or 'however' doesn't really matter
+      negations = list(lib.SENTIMENT_NEGATIONS)
+
+      # Remove movie names from the text, the utterance keeps the stemmed words that are left
+      utterance = self.analyze(text)
+      self.extract_titles(utterance, session=session)
+      words = utterance.words
+      posCount = self.sentiment_lexicon.score(words)
 
       if posCount != 0:
           posCount = posCount / abs(posCount)
           # Only update last_senti if a another sentiment word is extracted
-          self.last_senti = posCount
+          session.last_senti = posCount
 
       # Try to utilize memory of the last review to make a decision about sentiment
-      elif use_understand_previous_references and self.creative and self.last_senti != 0:
-          posCount = self.last_senti
+      elif use_understand_previous_references and self.creative and session.last_senti != 0:
+          posCount = session.last_senti
           negations.append('but')
           for neg_conj in negations:
               if neg_conj in words:
@@ -751,12 +909,60 @@ class Chatbot:
                   break
 
           # Only allow referencing memory once (no chaining)
-          self.last_senti = 0
+          session.last_senti = 0
 
       #print(posCount)
       return posCount
 
-    def extract_sentiment_for_movies(self, text):
+    def extract_sentiment_batch(self, texts, chunk_size=SENTIMENT_CHUNK_SIZE, processes=None):
+      """Extract the sentiment of many lines of text, e.g. a log of past reviews.
+
+      A generator that yields the sentiment of each text in order, -1, 0 or +1,
+      the same as extract_sentiment would without the memory of previous
+      reviews. The texts are read and scored chunk_size at a time, so results
+      stream out of arbitrarily long iterables, and the chatbot's conversation
+      state is never touched.
+
+      With processes set, chunks are scored by a pool of that many worker
+      processes, each with its own copy of the chatbot. At most
+      SENTIMENT_CHUNKS_PER_PROCESS chunks per process are read ahead of the
+      results consumed so far.
+
+      :param texts: an iterable of user-supplied lines of text
+      :param chunk_size: the number of texts scored together
+      :param processes: the number of worker processes, or None to score in this process
+      :returns: an iterator over the sentiment of each text
+      """
+      chunks = lib.chunked(texts, chunk_size)
+      if not processes:
+        for chunk in chunks:
+          yield from self.score_sentiment_chunk(chunk)
+        return
+
+      with multiprocessing.Pool(processes, initializer=init_sentiment_worker, initargs=(self,)) as pool:
+        # Pool.imap would read all of texts ahead, so chunks are submitted as results are taken
+        pending = collections.deque()
+        for chunk in chunks:
+          pending.append(pool.apply_async(score_sentiment_chunk, (chunk,)))
+          if len(pending) >= processes * SENTIMENT_CHUNKS_PER_PROCESS:
+            yield from pending.popleft().get()
+        while pending:
+          yield from pending.popleft().get()
+
+    def score_sentiment_chunk(self, texts):
+      """
+      Used by extract_sentiment_batch. Scores a list of texts together as numpy
+      operations on the compiled lexicon and returns their sentiments as a list.
+      """
+      word_lists = []
+      for text in texts:
+        utterance = self.analyze(text)
+        if utterance.titles is None:
+          utterance.titles, utterance.quoteless = self.scan_titles(utterance)
+        word_lists.append(utterance.words)
+      return np.sign(self.sentiment_lexicon.score_batch(word_lists)).tolist()
+
+    def extract_sentiment_for_movies(self, text, session=None):
       """Creative Feature: Extracts the sentiments from a line of text
       that may contain multiple movies. Note that the sentiments toward
       the movies may be different.
@@ -772,34 +978,33 @@ class Chatbot:
       :returns: a list of tuples, where the first item in the tuple is a movie title,
         and the second is the sentiment in the text toward that movie
       """
+      session = self.session if session is None else session
       # Enums for tracking token types
-      TKN_TITLE = 0
-      TKN_CONJ = 1
-      TKN_OTHER = 2
-
-      tagged_tokens = []
+      TKN_TITLE = lib.TKN_TITLE
+      TKN_CONJ = lib.TKN_CONJ
+      TKN_OTHER = lib.TKN_OTHER
 
       # TODO: need to tokenize by non-quote movies as well
 
       # Split text by sentence, then tokenize by conjuctions, movie titles, and other words
-      for sentence in re.split(r'\? |! |\. ', text):
-        tks = lib.tokenize_conj_movie_other(sentence)
-        tks.append((TKN_OTHER, '.'))
-        tagged_tokens = tagged_tokens + tks
+      def iter_tagged_tokens():
+        for sentence in re.split(r'\? |! |\. ', text):
+          yield from lib.iter_conj_movie_other(sentence)
+          yield (TKN_OTHER, '.')
 
       # Extract movie sentiments
       movie_sentiments = []
 
-      current_sentence = ''
+      current_words = []
       current_movies = []
       prev_neg_sentiment = None
 
-      for elem in tagged_tokens:
+      for elem in iter_tagged_tokens():
         tag, token = elem
 
         # skip conjunctions and movie titles
         if tag == TKN_OTHER:
-          current_sentence += token + ' '
+          current_words.append(token)
 
         # append to current_movies
         if tag == TKN_TITLE:
@@ -807,7 +1012,8 @@ class Chatbot:
 
         # check if end of sentence / phrase ('but' is the only conj that signals end of phrase)
         if (tag == TKN_CONJ and token.lower() == 'but') or (tag == TKN_OTHER and token == '.'):
-          sentiment = self.extract_sentiment(current_sentence)
+          current_sentence = ''.join(word + ' ' for word in current_words)
+          sentiment = self.extract_sentiment(current_sentence, session=session)
 
           # If neither nor exists in the current sentence, its sentiment is inverted.
           # Neither nor and only be checke at the end of sentence because neither usually appears before the movie title
@@ -831,12 +1037,12 @@ class Chatbot:
             # Reset negated sentiment tracker.
             prev_neg_sentiment = None
 
-          current_sentence = ''
+          current_words = []
           current_movies = []
 
       return movie_sentiments
 
-    def find_movies_closest_to_title(self, title, max_distance=EDIT_DIST):
+    def find_movies_closest_to_title(self, title, max_distance=EDIT_DIST, session=None):
       """Creative Feature: Given a potentially misspelled movie title,
       return a list of the movies in the dataset whose titles have the least edit distance
       from the provided title, and with edit distance at most max_distance.
@@ -854,7 +1060,8 @@ class Chatbot:
       :param max_distance: the maximum edit distance to search for
       :returns: a list of movie indices with titles closest to the given title and within edit distance max_distance
       """
-      return self.find_movies_by_title(title, max_distance)
+      session = self.session if session is None else session
+      return self.find_movies_by_title(title, max_distance, session=session)
 
 
     def disambiguate(self, clarification, candidates):
@@ -925,16 +1132,13 @@ class Chatbot:
 
       Entries whose values are 0 represent null values and should remain at 0.
 
-      :param x: a (num_movies x num_users) matrix of user ratings, from 0.5 to 5.0
+      :param x: a (num_movies x num_users) matrix of user ratings, from 0.5 to 5.0,
+        either a dense numpy array or a sparse CSRMatrix
       :param threshold: Numerical rating above which ratings are considered positive
 
       :returns: a binarized version of the movie-rating matrix
       """
-      binarized_ratings = ratings.copy()
-      binarized_ratings[np.where((binarized_ratings <= threshold) & (binarized_ratings != 0))] = -1
-      binarized_ratings[np.where(binarized_ratings > threshold)] = 1
-
-      return binarized_ratings
+      return recommender.binarize(ratings, threshold)
 
 
     def similarity(self, u, v):
@@ -942,11 +1146,15 @@ class Chatbot:
 
       You may assume that the two arguments have the same shape.
 
-      :param u: one vector, as a 1D numpy array
-      :param v: another vector, as a 1D numpy array
+      :param u: one vector, as a 1D numpy array or a 1 x n CSRMatrix
+      :param v: another vector, as a 1D numpy array or a 1 x n CSRMatrix
 
       :returns: the cosine similarity between the two vectors
       """
+      if isinstance(u, sparse.CSRMatrix):
+          u = u[0]
+      if isinstance(v, sparse.CSRMatrix):
+          v = v[0]
       norm1 = np.linalg.norm(u)
       norm2 = np.linalg.norm(v)
       if norm1 * norm2 == 0:
@@ -964,40 +1172,114 @@ class Chatbot:
       Remember to exclude movies the user has already rated!
 
       :param user_ratings: a binarized 1D numpy array of the user's movie ratings
-      :param ratings_matrix: a binarized 2D numpy matrix of all ratings, where
-        `ratings_matrix[i, j]` is the rating for movie i by user j
+      :param ratings_matrix: a binarized 2D numpy matrix or CSRMatrix of all
+        ratings, where `ratings_matrix[i, j]` is the rating for movie i by user j
       :param k: the number of recommendations to generate
       :param creative: whether the chatbot is in creative mode
 
       :returns: a list of k movie indices corresponding to movies in ratings_matrix,
         in descending order of recommendation
       """
-      recommendations = []
-      # Get the list of indices where the movie is rated and unrated
-      unrated_index = np.where(user_ratings == 0)[0]
-      rated_index = np.where(user_ratings != 0)[0]
+      # Reuse the engine built at load time when scoring against our own matrix
+      if ratings_matrix is self.ratings and RECOMMEND_ENGINE == 'neighbors':
+          return self.model.neighbor_engine().recommend(user_ratings, k, RECOMMEND_NEIGHBORS)
+      if ratings_matrix is self.ratings and RECOMMEND_ENGINE == 'factors':
+          return self.model.factor_engine().recommend(user_ratings, k)
+      if ratings_matrix is self.ratings and RECOMMEND_ENGINE == 'blocked':
+          return self.model.blocked_engine().recommend(user_ratings, k)
+
+      if ratings_matrix is self.ratings:
+          engine = self.engine
+      else:
+          engine = recommender.ItemItemEngine(ratings_matrix)
+
+      return engine.recommend(user_ratings, k)
 
-      # For each movie index of an unrated movie
-      for i in unrated_index:
-          unrated_vec = ratings_matrix[i]
-          score = 0
+    def recommend_batch(self, user_matrix, k=10, ratings_matrix=None, block_size=RECOMMEND_BLOCK_SIZE):
+      """Generate recommendations for many users at once, e.g. stored profiles.
 
-          # For each movie index rated by the user
-          for j in rated_index:
-              rated_rating = user_ratings[j]
-              rated_vec = ratings_matrix[j]
-              score += rated_rating * self.similarity(unrated_vec, rated_vec)
+      Always uses the exact item-item engine, building it first if the model
+      was loaded for the 'blocked' engine.
 
-          # Add score to the recommendations as a tuple (score of unrated movie, unrated movie index)
-          recommendations.append((score, i))
+      :param user_matrix: a binarized (num_users x num_movies) numpy matrix or
+        CSRMatrix, where row u holds the ratings of user u
+      :param k: the number of recommendations to generate for each user
+      :param ratings_matrix: a binarized matrix of all ratings as in recommend,
+        defaults to the chatbot's ratings
+      :param block_size: the number of users scored together
 
-      # Sort the list in descending order and take top k
-      recommendations = sorted(recommendations)[::-1][:k]
-      # Extract and keep only the movie index
-      recommendations = [elem[1] for elem in recommendations]
+      :returns: a (num_users x k) numpy array whose row u is
+        recommend(user_matrix[u], ratings_matrix, k), padded with -1 when the
+        user has fewer than k unrated movies
+      """
+      if ratings_matrix is None or ratings_matrix is self.ratings:
+          engine = self.engine
+      else:
+          engine = recommender.ItemItemEngine(ratings_matrix)
+      return engine.recommend_batch(user_matrix, k, block_size)
 
-      return recommendations
 
+    def update_scores(self, session):
+      """Bring session.scores up to date with session.user_ratings.
+
+      Only the exact engine uses the running scores, so with other engines
+      this does nothing until the exact engine is selected again. The scores
+      are allocated by the first update, from the ratings made so far.
+
+      The item-item score is linear in the ratings, so every newly rated movie
+      adds its rating times its cosine similarity to every other movie. Each
+      update costs one pass over the ratings matrix, however many movies the
+      user has rated. Summed this way, scores can differ from a fresh
+      engine.score by rounding, around 1e-15, which can only swap movies
+      whose scores are that close. Subtracting a cleared or flipped rating
+      would leave such residues on movies that should score exactly 0, so
+      the scores are recomputed from scratch instead.
+      """
+      if RECOMMEND_ENGINE != 'exact':
+        return
+      if session.scored_ratings is None:
+        session.scores = self.engine.score(session.user_ratings)
+        session.scored_ratings = session.user_ratings.copy()
+        return
+      changed = np.flatnonzero(session.user_ratings != session.scored_ratings)
+      if len(changed) == 0:
+        return
+      if session.scored_ratings[changed].any():
+        session.scores = self.engine.score(session.user_ratings)
+      else:
+        delta = np.zeros(len(session.scores))
+        delta[changed] = session.user_ratings[changed]
+        # A new array, as recommendation cursors may hold the old one
+        session.scores = session.scores + self.engine.score(delta)
+      session.scored_ratings[changed] = session.user_ratings[changed]
+
+    def session_scores(self, session):
+      """Return the recommendation score of every movie for a conversation.
+
+      With the exact engine these are the session's running scores; other
+      engines score the session's ratings from scratch.
+      """
+      if RECOMMEND_ENGINE == 'neighbors':
+        return self.model.neighbor_engine().score(session.user_ratings, RECOMMEND_NEIGHBORS)
+      if RECOMMEND_ENGINE == 'factors':
+        return self.model.factor_engine().score(session.user_ratings)
+      if RECOMMEND_ENGINE == 'blocked':
+        return self.model.blocked_engine().score(session.user_ratings)
+      self.update_scores(session)
+      return session.scores
+
+    def recommend_session(self, session, k=10):
+      """Return the indices of the top k movies to recommend in a conversation."""
+      return recommender.top_k(self.session_scores(session), session.user_ratings, k)
+
+    def recommendation_cursor(self, session, page_size=NUM_REC):
+      """Return a RecommendationCursor over the session's current scores.
+
+      The cursor holds the scores as they are now. update_scores replaces
+      session.scores instead of changing it, so later ratings only change the
+      recommendations once a new cursor is made.
+      """
+      return recommender.RecommendationCursor(self.session_scores(session), session.user_ratings, page_size)
 
     #############################################################################
     # 4. Debug info                                                             #
@@ -1007,7 +1289,7 @@ class Chatbot:
       """Return debug information as a string for the line string from the REPL"""
       # Pass the debug information that you may think is important for your
       # evaluators
-      debug_info = 'debug info'
+      debug_info = 'debug info\n{}'.format(lib.stem_cache)
       return debug_info
 
 
@@ -1085,6 +1367,11 @@ class Chatbot:
       """
 
 
+# The REPL's conversation state stays reachable as chatbot.<name>
+for name in Session.__slots__:
+    setattr(Chatbot, name, session_property(name))
+
+
 if __name__ == '__main__':
   print('To run your chatbot in an interactive loop from the command line, run:')
   print('    python3 repl.py')
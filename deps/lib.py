@@ -2,8 +2,12 @@
 Utility file with functions that handle movie extraction and stemming
 """
 
+import collections
+import itertools
 import re
 import random
+import threading
+import numpy as np
 import PorterStemmer as ps
 
 ## Movie title extraction helpers ##
@@ -188,6 +192,44 @@ def extract_title_by_word(movie_title, input_text):
 
     return False
 
+class TitleWordMatcher:
+    """Finds every title extract_title_by_word could match in an input text in
+    one pass over the text's words.
+
+    extract_title_by_word matches the words of a title in order but not
+    necessarily next to each other, so a title can only match when all of its
+    words appear in the text. The matcher keeps an inverted index from each
+    lowercased title word to the titles containing it, counts for every title
+    how many of its distinct words the text contains, and returns the titles
+    where that count is complete. Callers confirm the candidates with
+    extract_title_by_word.
+    """
+
+    def __init__(self, titles):
+        by_word = {}
+        self.num_words = np.zeros(len(titles), dtype=np.int32)
+        for i, (title, _, _) in enumerate(titles):
+            words = set(title.lower().split())
+            self.num_words[i] = len(words)
+            for word in words:
+                by_word.setdefault(word, []).append(i)
+        self.by_word = {word: np.array(indices, dtype=np.int32) for word, indices in by_word.items()}
+
+    def candidates(self, input_text):
+        """Indices, in ascending order, of the titles whose words all appear in
+        input_text, which must already be lowercased."""
+        words = set(input_text.split())
+
+        # The last word of a title may match an input word without its ending
+        # punctuation, see extract_title_by_word
+        words.update([word[:-1] for word in words if not word[-1].isalnum()])
+
+        postings = [self.by_word[word] for word in words if word in self.by_word]
+        if len(postings) == 0:
+            return []
+        counts = np.bincount(np.concatenate(postings), minlength=len(self.num_words))
+        return np.flatnonzero(counts == self.num_words).tolist()
+
 """
 Used to determine if a string is a word-by-word substring of the movie title
 Takes in the substring to check and a movie title
@@ -224,133 +266,354 @@ def title_contains_words(substring, movie_title):
 
     return False
 
+"""
+Splits text into its maximal runs of alphabetic characters
+For example, "harry potter & the half-blood prince" ->
+["harry", "potter", "the", "half", "blood", "prince"]
+"""
+def alpha_words(text):
+    return [''.join(run) for is_alpha, run in itertools.groupby(text, str.isalpha) if is_alpha]
+
+## Movie title index ##
+
+class TitleIndex:
+    """Inverted index over standardized [title, year, genres] entries.
+
+    Maps exact titles, lowercased titles, lowercased alphabetic words and years
+    to the (ascending) indices of the entries that have them, so title lookups
+    only visit the entries that can match instead of the whole catalogue.
+    """
+
+    def __init__(self, titles):
+        self.size = len(titles)
+        self.by_title = {}
+        self.by_lower_title = {}
+        self.by_word = {}
+        self.by_year = {}
+
+        # Entries whose title changes length when lowercased can not be matched
+        # by word reliably, so they are always returned as candidates
+        self.irregular = []
+
+        for i, (title, year, _) in enumerate(titles):
+            lower_title = title.lower()
+            self.by_title.setdefault(title, []).append(i)
+            self.by_lower_title.setdefault(lower_title, []).append(i)
+            self.by_year.setdefault(year, []).append(i)
+
+            if len(lower_title) != len(title):
+                self.irregular.append(i)
+            for word in set(alpha_words(lower_title)):
+                self.by_word.setdefault(word, []).append(i)
+
+    def exact(self, title):
+        """Indices of entries whose title is exactly title."""
+        return self.by_title.get(title, [])
+
+    def exact_lower(self, title):
+        """Indices of entries whose title equals title, ignoring case."""
+        return self.by_lower_title.get(title.lower(), [])
+
+    def year(self, year):
+        """Indices of entries released in year."""
+        return self.by_year.get(year, [])
+
+    def containing_words(self, substring):
+        """Indices of entries that title_contains_words(substring, title) may be
+        true for: every alphabetic word of substring is also a word of the title.
+
+        Returns None when substring has no alphabetic words to narrow by, in
+        which case every entry is a candidate.
+        """
+        if substring == "":
+            return []
+
+        # Stripping punctuation off the ends, as title_contains_words does,
+        # never changes the alphabetic words
+        words = alpha_words(substring.lower())
+        if len(words) == 0:
+            return None
+
+        postings = sorted((self.by_word.get(word, []) for word in set(words)), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return sorted(candidates.union(self.irregular))
+
 """
 Calculates the minimum edit distance between w1 and w2.
 Insertions, deletions have cost of 1, and replacements have cost of 2.
+The table is filled iteratively, keeping only the previous and current rows.
+If max_distance is given, returns max_distance + 1 as soon as the distance is
+known to be greater than max_distance: when the lengths already differ by more,
+or when every cell of a row does (row minimums never decrease).
 """
-cache = {}
-def min_edit_distance(w1, w2):
-    cache = {}
-    return min_edit_distance_helper(w1, w2, len(w1)-1, len(w2)-1, cache)
-
-def min_edit_distance_helper(w1, w2, i1, i2, cache):
-    # base case
-    if i1 == -1:
-        return i2 + 1
-    if i2 == -1:
-        return i1 + 1
-
-    # recursive cases
-    if w1[i1] == w2[i2]:
-        k = (i1-1, i2-1)
-        if k not in cache:
-            ed = min_edit_distance_helper(w1, w2, i1-1, i2-1, cache)
-        else:
-            ed = cache[k]
-    else:
-        k1 = (i1-1, i2)
-        if k1 not in cache:
-            ed1 = min_edit_distance_helper(w1, w2, i1-1, i2, cache) + 1
-        else:
-            ed1 = cache[k1] + 1
+def min_edit_distance(w1, w2, max_distance=None):
+    if max_distance is not None and abs(len(w1) - len(w2)) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(w2) + 1))
+    for i, c1 in enumerate(w1, 1):
+        current = [i]
+        for j, c2 in enumerate(w2, 1):
+            if c1 == c2:
+                current.append(previous[j - 1])
+            else:
+                current.append(min(previous[j], current[j - 1]) + 1)
 
-        k2 = (i1, i2-1)
-        if k2 not in cache:
-            ed2 = min_edit_distance_helper(w1, w2, i1, i2-1, cache) + 1
-        else:
-            ed2 = cache[k2] + 1
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
 
-        ed = min(ed1, ed2)
+    if max_distance is not None and previous[-1] > max_distance:
+        return max_distance + 1
+    return previous[-1]
 
-    k = (i1, i2)
-    cache[k] = ed
+"""
+Calculates min_edit_distance from query to every title of titles_array at once.
+titles_array is a numpy unicode array (or a list of strings), which numpy
+already stores as a padded matrix of character codes. The table is filled one
+title position (column) at a time for all titles and query positions together.
+Within a column, D[i] = min(A[i], D[i-1] + 1) where A[i] only depends on the
+previous column, so the column is i + the running minimum of A[i] - i.
+If max_distance is given, titles whose length differs from the query's by more
+are skipped, and every distance greater than max_distance is max_distance + 1.
+Returns an int array with one distance per title.
+"""
+def edit_distances(query, titles_array, max_distance=None):
+    titles_array = np.ascontiguousarray(titles_array, dtype=str)
+    num_titles = len(titles_array)
+    lengths = np.char.str_len(titles_array) if num_titles > 0 else np.zeros(0, dtype=int)
+    m = len(query)
+
+    distances = np.abs(lengths - m)
+    candidates = np.arange(num_titles)
+    if max_distance is not None:
+        candidates = candidates[distances <= max_distance]
+        distances = np.full(num_titles, max_distance + 1)
+
+    # One row of character codes per candidate title, padded with zeros
+    width = titles_array.dtype.itemsize // 4
+    codes = titles_array.view(np.uint32).reshape(num_titles, width)[candidates]
+    candidate_lengths = lengths[candidates]
+    query_codes = np.array([ord(c) for c in query], dtype=np.uint32)
+    steps = np.arange(m + 1)
+
+    column = np.tile(steps, (len(candidates), 1))
+    distances[candidates[candidate_lengths == 0]] = m
+    for j in range(int(candidate_lengths.max()) if len(candidates) > 0 else 0):
+        matches = query_codes[None, :] == codes[:, j, None]
+
+        a = np.empty_like(column)
+        a[:, 0] = j + 1
+        a[:, 1:] = np.where(matches, column[:, :-1], column[:, 1:] + 1)
+        column = np.minimum.accumulate(a - steps, axis=1) + steps
+
+        done = candidate_lengths == j + 1
+        distances[candidates[done]] = column[done, m]
+
+    if max_distance is not None:
+        distances[distances > max_distance] = max_distance + 1
+    return distances
 
-    return ed
+"""
+Calculates the same distance as min_edit_distance (insertions and deletions
+cost 1, replacements cost 2), which is len(w1) + len(w2) - 2 * LCS(w1, w2).
+The longest common subsequence is computed bit-parallel, with one bit per
+character of w1 packed into an integer, so each character of w2 costs a few
+integer operations instead of a row of the dynamic programming table.
+"""
+def indel_distance(w1, w2):
+    masks = {}
+    for i, c in enumerate(w1):
+        masks[c] = masks.get(c, 0) | (1 << i)
+
+    all_ones = (1 << len(w1)) - 1
+    v = all_ones
+    for c in w2:
+        u = v & masks.get(c, 0)
+        v = ((v + u) | (v - u)) & all_ones
+
+    lcs = len(w1) - bin(v).count('1')
+    return len(w1) + len(w2) - 2 * lcs
+
+class BKTree:
+    """BK-tree over strings under indel_distance, used for spell correction.
+
+    Every node is a [key, indices, children] list, where children maps a
+    distance d to the subtree of keys at distance d from key. Because the
+    distance is a metric, a search for keys within r of a word only needs to
+    descend into children whose distance is within r of the word's distance to
+    the node, which skips most of the catalogue.
+    """
+
+    def __init__(self, items=()):
+        self.root = None
+        for key, index in items:
+            self.add(key, index)
+
+    def add(self, key, index):
+        """Adds index under key. Indices sharing a key share one node."""
+        if self.root is None:
+            self.root = [key, [index], {}]
+            return
+
+        node = self.root
+        while True:
+            dist = indel_distance(key, node[0])
+            if dist == 0:
+                node[1].append(index)
+                return
+            if dist not in node[2]:
+                node[2][dist] = [key, [index], {}]
+                return
+            node = node[2][dist]
+
+    def search(self, word, max_distance, accept=None):
+        """Finds the indices whose key is closest to word, at distance at most
+        max_distance. If accept is given, only indices it returns True for are
+        considered. The search radius shrinks to the best distance found so far.
+
+        Returns (indices tied for the minimum distance in ascending order,
+        number of nodes visited)
+        """
+        best = max_distance
+        matches = []
+        visited = 0
+
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            visited += 1
+            dist = indel_distance(word, node[0])
+
+            if dist <= best:
+                indices = [i for i in node[1] if accept is None or accept(i)]
+                if len(indices) > 0:
+                    if dist < best:
+                        best = dist
+                        matches = []
+                    matches.extend(indices)
+
+            for child_dist, child in node[2].items():
+                if dist - best <= child_dist <= dist + best:
+                    stack.append(child)
+
+        return sorted(matches), visited
 
 ## Movies sentiment extraction helpers ##
 
+# Tags of the tokens produced by iter_conj_movie_other
+TKN_TITLE = 0
+TKN_CONJ = 1
+TKN_OTHER = 2
+
+# Coordinating conjunctions: for, and, nor, but, or, yet, so
+# conjunctions = {'for', 'and', 'nor', 'but', 'or', 'yet', 'so'}
+# or, nor, and -> same clause
+# but -> diff clause
+CONJUNCTIONS = {'and', 'nor', 'but', 'or'}
+
 """
 Tokenize text to separate into segments (tokens) of conjunctions,
 movie titles, and other words.
 Note: assumes that all words within "" are movie titles
+Yields (<tag>, <token>) pairs in a single pass over the text, skipping empty tokens.
+"""
+def iter_conj_movie_other(text):
+    start = 0
+    in_title = False
+    while True:
+        end = text.find('\"', start)
+        segment = text[start:] if end == -1 else text[start:end]
+
+        if in_title:
+            if segment != '':
+                yield (TKN_TITLE, segment)
+        else:
+            # tokenize by conjunctions, i.e. create tokens of
+            # [<non-conj-words>, <conj>, <non-conj-words>, ...]
+            string_builder = []
+            for word in segment.split():
+                if word.lower() not in CONJUNCTIONS:
+                    # Non-conjunction word, continue building word token
+                    string_builder.append(word)
+                else:
+                    # Word is a conjunction
+                    if len(string_builder) > 0:
+                        yield (TKN_OTHER, ' '.join(string_builder))
+                    yield (TKN_CONJ, word)
+                    string_builder = []
+            if len(string_builder) > 0:
+                yield (TKN_OTHER, ' '.join(string_builder))
+
+        if end == -1:
+            return
+        start = end + 1
+        in_title = not in_title
+
+"""
+List version of iter_conj_movie_other.
 Returns list of [(<tag>, <token>), (<tag>, <token>), ...]
 """
 def tokenize_conj_movie_other (text):
-    # Coordinating conjunctions: for, and, nor, but, or, yet, so
-    # conjunctions = {'for', 'and', 'nor', 'but', 'or', 'yet', 'so'}
-    # or, nor, and -> same clause
-    # but -> diff clause
-    conjunctions = {'and', 'nor', 'but', 'or'}
-
-    TKN_TITLE = 0
-    TKN_CONJ = 1
-    TKN_OTHER = 2
-
-    processed_tokens = []
-
-    tokens = text.split('\"')
-    i = 0
-    while (i < len(tokens)):
-        assert (i % 2 == 0)
-
-        # token[i] is a non-movie segment of words
-        word_segment = tokens[i]
-
-        # tokenize by conjunctions, i.e. create tokens of
-        # [<non-conj-words>, <conj>, <non-conj-words>, ...]
-        word_tokens = word_segment.split()
-        string_builder = []
-        conj_tokenized_words = []
-
-        for word in word_tokens:
-            if word.lower() not in conjunctions:
-                # Non-conjunction word, continue building word token
-                string_builder.append(word)
-            else:
-                # Word is a conjunction
-                conj_tokenized_words.append((TKN_OTHER, ' '.join(string_builder)))
-                conj_tokenized_words.append((TKN_CONJ, word))
-                string_builder = []
-
-        if len(string_builder) > 0:
-            conj_tokenized_words.append((TKN_OTHER, ' '.join(string_builder)))
-
-        processed_tokens = processed_tokens + conj_tokenized_words
-
-        if (i + 1) < len(tokens):
-            movie_title = tokens[i + 1]
-            processed_tokens.append((TKN_TITLE, movie_title))
-
-        i += 2
-
-    # Remove all empty tokens
-    tagged_tokens = []
-    for elem in processed_tokens:
-        (_, token) = elem
-        if token != '':
-            tagged_tokens.append(elem)
-
-    return tagged_tokens
+    return list(iter_conj_movie_other(text))
 
 ## Stemming helpers##
 
+# Number of distinct words whose stems are remembered
+STEM_CACHE_SIZE = 1 << 16
+
+class StemCache:
+    """Bounded LRU cache of lowercase word -> Porter stem.
+
+    Counts hits and misses so the cache can be sized. Safe to share between
+    threads; the stemmer itself keeps per-word state, so a fresh one is used
+    for every miss.
+    """
+
+    def __init__(self, maxsize=STEM_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.stems = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def stem(self, word):
+        with self.lock:
+            stem = self.stems.get(word)
+            if stem is not None:
+                self.stems.move_to_end(word)
+                self.hits += 1
+                return stem
+            self.misses += 1
+
+        stem = ps.PorterStemmer().stem(word, 0, len(word) - 1)
+        self.seed({word: stem})
+        return stem
+
+    def seed(self, stems):
+        """Adds precomputed word -> stem pairs, e.g. for the lexicon vocabulary."""
+        with self.lock:
+            self.stems.update(stems)
+            while len(self.stems) > self.maxsize:
+                self.stems.popitem(last=False)
+
+    def __repr__(self):
+        return 'StemCache({} words, {} hits, {} misses)'.format(len(self.stems), self.hits, self.misses)
+
+# Shared by every stem_text call in the process
+stem_cache = StemCache()
+
 """
 Takes in a text string and returns the text string stemmed using PorterStemmer
+Runs of letters are lowercased and stemmed through stem_cache, everything else
+is only lowercased.
 """
 def stem_text(text):
-  stemmer = ps.PorterStemmer()
-  output = ''
-  word = ''
-  for c in text:
-      if c.isalpha():
-          word += c.lower()
-      else:
-          if word:
-              output += stemmer.stem(word, 0,len(word)-1)
-              word = ''
-          output += c.lower()
-  output += stemmer.stem(word, 0,len(word)-1)
-  return output
+  output = []
+  for is_alpha, run in itertools.groupby(text, str.isalpha):
+      run = ''.join(run).lower()
+      output.append(stem_cache.stem(run) if is_alpha else run)
+  return ''.join(output)
 
 """
 Takes a map from words to 'pos' 'neg' labels and updates the keys into its stemmed
@@ -365,6 +628,133 @@ def stem_map(mapping):
 
     return result
 
+## Sentiment helpers ##
+
+# Words that flip the sign of every sentiment word after them, up to the end of the sentence
+SENTIMENT_NEGATIONS = ('don\'t', 'not', 'never', 'none', 'nothing', 'hardly', 'didn\'t', 'no')
+
+# Words that discard the sentiment of everything said before them
+SENTIMENT_RESETS = ('but', 'however')
+
+class SentimentLexicon:
+    """Stemmed sentiment lexicon compiled into a token-id vocabulary.
+
+    Token id 0 stands for every word outside the vocabulary. polarity holds
+    +1/-1 for lexicon words, and negation and reset flag the words in
+    SENTIMENT_NEGATIONS and SENTIMENT_RESETS, so reviews can be scored as
+    numpy operations over arrays of token ids.
+    """
+
+    def __init__(self, stemmed_sentiment, negations=SENTIMENT_NEGATIONS, resets=SENTIMENT_RESETS):
+        words = sorted(set(stemmed_sentiment) | set(negations) | set(resets))
+        self.vocabulary = {word: i + 1 for i, word in enumerate(words)}
+
+        self.polarity = np.zeros(len(words) + 1, dtype=np.int8)
+        for word, label in stemmed_sentiment.items():
+            self.polarity[self.vocabulary[word]] = 1 if label == 'pos' else -1
+
+        self.negation = np.zeros(len(words) + 1, dtype=bool)
+        self.negation[[self.vocabulary[word] for word in negations]] = True
+        # A negation word is never also a reset
+        self.reset = np.zeros(len(words) + 1, dtype=bool)
+        self.reset[[self.vocabulary[word] for word in resets]] = True
+        self.reset &= ~self.negation
+
+    def encode(self, words):
+        """Returns the token ids of words and which of them end a sentence.
+
+        A word ends a sentence when its last character is punctuation other
+        than a comma, which is where the negation scope stops.
+        """
+        ids = np.array([self.vocabulary.get(word, 0) for word in words], dtype=np.int32)
+        ends = np.array([not word[-1].isalpha() and word[-1] != ',' for word in words], dtype=bool)
+        return ids, ends
+
+    def score_batch(self, word_lists):
+        """Returns the net sentiment count of each list of stemmed words.
+
+        Every sentiment word adds its polarity, flipped once for each negation
+        since the last sentence end; a word that ends a sentence is never
+        flipped. Only the words from the last reset word onwards count.
+        """
+        encoded = [self.encode(words) for words in word_lists]
+        lengths = np.array([len(ids) for ids, _ in encoded], dtype=np.int64)
+        if lengths.sum() == 0:
+            return np.zeros(len(word_lists), dtype=np.int64)
+        ids = np.concatenate([ids for ids, _ in encoded])
+        ends = np.concatenate([ends for _, ends in encoded])
+        starts = np.cumsum(lengths) - lengths
+        text_ids = np.repeat(np.arange(len(word_lists)), lengths)
+
+        # Negations seen so far, and how many of them were before the current
+        # negation scope, which restarts after a sentence end or at a new text
+        negations = np.cumsum(self.negation[ids])
+        scope_start = np.zeros(len(ids), dtype=np.int64)
+        after_end = np.flatnonzero(ends[:-1]) + 1
+        scope_start[after_end] = negations[after_end - 1]
+        nonempty = starts[lengths > 0]
+        scope_start[nonempty] = negations[nonempty] - self.negation[ids[nonempty]]
+        np.maximum.accumulate(scope_start, out=scope_start)
+
+        flipped = ((negations - scope_start) % 2 == 1) & ~ends
+        scores = np.where(flipped, -self.polarity[ids], self.polarity[ids])
+
+        # Keep the words at or after the last reset of their text
+        resets = np.cumsum(self.reset[ids])
+        last = np.cumsum(lengths)[text_ids] - 1
+        scores[resets != resets[last]] = 0
+
+        return np.bincount(text_ids, weights=scores, minlength=len(word_lists)).astype(np.int64)
+
+    def score(self, words):
+        return int(self.score_batch([words])[0])
+
+## Utterance helpers ##
+
+class Utterance:
+    """One line of user input and everything derived from it.
+
+    The chatbot creates one Utterance per line and passes it through all of its
+    stages, so the line is lowercased, title-scanned and stemmed only once.
+    titles and quoteless are filled in by Chatbot.extract_titles; words are
+    the stemmed words of the line with those titles removed.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.lower = text.lower()
+        self.titles = None
+        self.quoteless = False
+        self._words = None
+
+    @property
+    def words(self):
+        if self._words is None:
+            if self.titles is None:
+                raise ValueError('titles must be extracted before the words of an utterance')
+            text = self.lower
+            for title in self.titles:
+                text = text.replace(title.lower(), '')
+            self._words = stem_text(text).split()
+        return self._words
+
+    def __repr__(self):
+        return 'Utterance({!r})'.format(self.text)
+
+"""
+Splits an iterable into lists of size items, the last list may be shorter.
+Reads the iterable lazily, one list at a time.
+"""
+def chunked(iterable, size):
+    if size < 1:
+        raise ValueError('chunk size must be at least 1, got {}'.format(size))
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
 ## Response helpers ##
 """
 Takes in a corpus, which is a list of potential responces.
@@ -0,0 +1,429 @@
+"""
+Recommendation engines used by the chatbot to score movies for a user
+"""
+
+import heapq
+
+import numpy as np
+
+from deps.sparse import CSRMatrix
+
+# Entries of the normalized rows ItemItemEngine.profiles gathers at a time
+PROFILE_CHUNK_SIZE = 1 << 18
+
+## Vector helpers ##
+
+"""
+Returns a float copy of matrix where every row is scaled to unit L2 norm.
+Rows that are all zeros stay all zeros. Sparse matrices stay sparse.
+"""
+def normalize_rows(matrix):
+    if isinstance(matrix, CSRMatrix):
+        norms = matrix.row_norms()
+        norms[norms == 0] = 1
+        return matrix.scale_rows(1 / norms)
+
+    matrix = np.asarray(matrix, dtype=float)
+    norms = np.linalg.norm(matrix, axis=1)
+    norms[norms == 0] = 1
+    return matrix / norms[:, None]
+
+"""
+Takes a score for every movie and the user's ratings vector.
+Returns the indices of the k highest scoring movies the user has not rated, in
+descending order of score. Ties are broken by the larger movie index first, the
+same order as sorting (score, index) tuples and reversing the list.
+"""
+def top_k(scores, user_ratings, k):
+    candidates = np.flatnonzero(np.asarray(user_ratings) == 0)
+    candidate_scores = scores[candidates]
+
+    # Only fully sort the candidates that can make it into the top k
+    if 0 < k < len(candidates):
+        kth_score = np.partition(candidate_scores, len(candidates) - k)[len(candidates) - k]
+        keep = candidate_scores >= kth_score
+        candidates = candidates[keep]
+        candidate_scores = candidate_scores[keep]
+
+    order = np.lexsort((-candidates, -candidate_scores))
+    return candidates[order[:k]].tolist()
+
+"""
+Row by row top_k: takes a (num_users x num_movies) matrix of scores and the
+matching ratings, and returns a (num_users x k) int64 array whose row u is
+top_k(scores[u], user_ratings[u], k). Rows with fewer than k unrated movies are
+padded with -1.
+"""
+def top_k_rows(scores, user_ratings, k):
+    num_users, num_movies = scores.shape
+    result = np.full((num_users, k), -1, dtype=np.int64)
+    width = min(k, num_movies)
+    if width == 0:
+        return result
+    scores = np.where(user_ratings != 0, -np.inf, scores)
+
+    best = np.argpartition(scores, num_movies - width, axis=1)[:, num_movies - width:]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    order = np.lexsort((-best, -best_scores), axis=1)
+    result[:, :width] = np.take_along_axis(best, order, axis=1)
+
+    # argpartition picks any of the movies tied with the kth score, and rated
+    # movies when too few are unrated, so those rows are selected again
+    kth_score = best_scores.min(axis=1)
+    redo = ((scores >= kth_score[:, None]).sum(axis=1) != width) | (kth_score == -np.inf)
+    for user in np.flatnonzero(redo):
+        top = top_k(scores[user], user_ratings[user], k)
+        result[user] = -1
+        result[user, :len(top)] = top
+    return result
+
+"""
+Returns a binarized copy of a ratings matrix: ratings above threshold become 1,
+ratings at or below it -1, and 0 entries (no rating) stay 0. Only the stored
+ratings of a CSRMatrix are touched.
+"""
+def binarize(ratings, threshold=2.5):
+    if isinstance(ratings, CSRMatrix):
+        return ratings.with_data(binarize(ratings.data, threshold))
+
+    binarized_ratings = ratings.copy()
+    binarized_ratings[np.where((binarized_ratings <= threshold) & (binarized_ratings != 0))] = -1
+    binarized_ratings[np.where(binarized_ratings > threshold)] = 1
+    return binarized_ratings
+
+"""
+Returns the num_neighbors most cosine-similar movies of every movie as
+(neighbors, scores), int32 and float32 arrays of shape (num_movies, num_neighbors)
+sorted by descending score. A movie is never its own neighbor. normalized is
+the row-normalized ratings matrix, dense or a CSRMatrix that is kept sparse.
+The similarities are computed block_size rows at a time, only densifying the
+block, so memory stays at block_size x (num_movies + num_users) entries.
+"""
+def build_neighbor_table(normalized, num_neighbors, block_size=1024):
+    if isinstance(normalized, CSRMatrix):
+        normalized = normalized.with_data(np.asarray(normalized.data, dtype=np.float32))
+    else:
+        normalized = np.asarray(normalized, dtype=np.float32)
+    num_movies = normalized.shape[0]
+    num_neighbors = min(num_neighbors, num_movies - 1)
+
+    neighbors = np.zeros((num_movies, num_neighbors), dtype=np.int32)
+    scores = np.zeros((num_movies, num_neighbors), dtype=np.float32)
+    for start in range(0, num_movies, block_size):
+        rows = np.arange(start, min(start + block_size, num_movies))
+        block = normalized[start:start + block_size]
+        if isinstance(block, CSRMatrix):
+            block = block.toarray()
+        # Against the whole matrix on the left, so a CSRMatrix is multiplied as it is stored
+        similarities = np.ascontiguousarray((normalized @ block.T).T)
+        similarities[np.arange(len(rows)), rows] = -np.inf
+
+        # Same order as top_k: descending score, ties to the larger index
+        best = np.argpartition(-similarities, num_neighbors - 1, axis=1)[:, :num_neighbors]
+        best_scores = np.take_along_axis(similarities, best, axis=1)
+        order = np.lexsort((-best, -best_scores), axis=1)
+        neighbors[rows] = np.take_along_axis(best, order, axis=1)
+        scores[rows] = np.take_along_axis(best_scores, order, axis=1)
+    return neighbors, scores
+
+"""
+Returns a rank num_factors approximation (left, singular_values, right) of a
+dense or CSRMatrix matrix, with left and right holding the top singular vectors
+as columns and rows. Computed with randomized subspace iteration: the matrix is
+only multiplied with thin dense matrices, densifying block_size rows at a time,
+so memory stays at a few (rows + columns) x num_factors arrays.
+"""
+def truncated_svd(matrix, num_factors, num_iterations=4, oversample=10, block_size=1024, seed=0):
+    num_rows, num_columns = matrix.shape
+    width = min(num_factors + oversample, num_rows, num_columns)
+
+    def dense_blocks():
+        for start in range(0, num_rows, block_size):
+            block = matrix[start:start + block_size]
+            if isinstance(block, CSRMatrix):
+                block = block.toarray()
+            yield start, np.asarray(block, dtype=float)
+
+    basis = np.random.RandomState(seed).standard_normal((num_columns, width))
+    for iteration in range(num_iterations + 1):
+        # An orthonormal basis of the range of matrix @ basis...
+        column_space = np.zeros((num_rows, width))
+        for start, block in dense_blocks():
+            column_space[start:start + len(block)] = block @ basis
+        column_space, _ = np.linalg.qr(column_space)
+        # ...and of matrix.T @ column_space, which the next iteration starts from
+        row_space = np.zeros((num_columns, width))
+        for start, block in dense_blocks():
+            row_space += block.T @ column_space[start:start + len(block)]
+        if iteration < num_iterations:
+            basis, _ = np.linalg.qr(row_space)
+
+    # matrix is close to column_space @ row_space.T, whose SVD is cheap
+    small_left, singular_values, right = np.linalg.svd(row_space.T, full_matrices=False)
+    left = column_space @ small_left
+    return left[:, :num_factors], singular_values[:num_factors], right[:num_factors]
+
+"""
+Returns the float32 (num_movies x num_factors) movie factors of a binarized
+(num_movies x num_users) ratings matrix: the top singular vectors of the
+matrix, scaled by their singular values. Missing ratings count as 0, so the
+factors reconstruct each user's like, dislike or no rating of every movie.
+"""
+def build_movie_factors(ratings, num_factors, seed=0):
+    left, singular_values, _ = truncated_svd(ratings, num_factors, seed=seed)
+    return (left * singular_values).astype(np.float32)
+
+class RecommendationCursor:
+    """Recommendations for one user, selected a page at a time.
+
+    Each page is the top page_size movies the user has neither rated nor been
+    recommended yet, found by partial selection over the scores. Paging
+    through every page gives the same order as one full sort, without ever
+    sorting the whole catalogue.
+
+    The cursor only keeps a reference to scores, which must not be changed
+    while it is used, and a bitmask of the movies it may no longer suggest.
+    """
+
+    def __init__(self, scores, user_ratings, page_size=10):
+        self.scores = scores
+        self.page_size = page_size
+        # Movies the user rated or was already recommended
+        self.excluded = np.asarray(user_ratings) != 0
+        self.page = []
+        self.count = 0
+
+    def next_page(self):
+        """Return the next page of movie indices, an empty list when none are left."""
+        # Excluded movies count as rated
+        page = top_k(self.scores, self.excluded, self.page_size)
+        self.excluded[page] = True
+        return page
+
+    def next(self):
+        """Return the next movie index to recommend, or None when none are left."""
+        if not self.page:
+            self.page = self.next_page()
+            if not self.page:
+                return None
+        self.count += 1
+        return self.page.pop(0)
+
+## Engines ##
+
+class ItemItemEngine:
+    """Item-item collaborative filtering with cosine similarity.
+
+    The (num_movies x num_users) ratings matrix, dense or a sparse CSRMatrix,
+    is L2-normalized once when the engine is built, so the cosine similarity
+    between two movies is the dot product of their rows. Scoring a user is then
+    one product to build the user's profile over the rated rows and one
+    matrix-vector product over the whole catalogue.
+    """
+
+    def __init__(self, ratings_matrix):
+        self.normalized = normalize_rows(ratings_matrix)
+
+    @classmethod
+    def from_normalized(cls, normalized):
+        """Build an engine from an already row-normalized matrix."""
+        engine = cls.__new__(cls)
+        engine.normalized = normalized
+        return engine
+
+    def score(self, user_ratings):
+        """Return the item-item score of every movie for the given user.
+
+        score[i] is the sum over rated movies j of user_ratings[j] * cos(i, j).
+        """
+        user_ratings = np.asarray(user_ratings, dtype=float)
+        rated_index = np.flatnonzero(user_ratings)
+        profile = user_ratings[rated_index] @ self.normalized[rated_index]
+        return self.normalized @ profile
+
+    def recommend(self, user_ratings, k=10):
+        """Return the indices of the top k unrated movies for the user."""
+        return top_k(self.score(user_ratings), user_ratings, k)
+
+    def profiles(self, users):
+        """Return the profile of every row of a dense users x movies ratings
+        matrix, the sum of the normalized rows of their rated movies weighted
+        by rating, as score() builds it for one user."""
+        if not isinstance(self.normalized, CSRMatrix):
+            return users @ self.normalized
+
+        # Gather the normalized row of every rated (user, movie) pair, and sum
+        # them by (user, column) in the same order score() does. Users go in
+        # groups gathering about PROFILE_CHUNK_SIZE entries at a time.
+        user_index, movie_index = np.nonzero(users)
+        values = users[user_index, movie_index]
+        num_columns = self.normalized.shape[1]
+        row_lengths = np.diff(self.normalized.indptr)[movie_index]
+        gathered = np.cumsum(np.bincount(user_index, weights=row_lengths, minlength=len(users)))
+        profiles = np.zeros((len(users), num_columns))
+        start = 0
+        while start < len(users):
+            before = gathered[start - 1] if start > 0 else 0
+            stop = max(start + 1, int(np.searchsorted(gathered, before + PROFILE_CHUNK_SIZE, side='right')))
+            first, last = np.searchsorted(user_index, [start, stop])
+            rows = self.normalized[movie_index[first:last]]
+            pairs = rows.row_ids() + first
+            cells = (user_index[pairs] - start) * num_columns + rows.indices
+            weights = rows.data * values[pairs]
+            sums = np.bincount(cells, weights=weights, minlength=(stop - start) * num_columns)
+            profiles[start:stop] = sums.reshape(stop - start, num_columns)
+            start = stop
+        return profiles
+
+    def recommend_batch(self, user_matrix, k=10, block_size=256):
+        """Return the top k unrated movies of many users at once.
+
+        user_matrix is a (num_users x num_movies) ratings matrix, dense or a
+        CSRMatrix, and row u of the returned (num_users x k) array is
+        recommend(user_matrix[u], k), padded with -1, see top_k_rows.
+
+        The users are scored block_size at a time: their profiles are
+        gathered from the rows of the movies they rated, then scored with one
+        product of the normalized ratings and the block's profiles. Sparse
+        ratings stay sparse, so memory stays at the ratings plus a few
+        block_size x num_movies arrays.
+        """
+        num_users = user_matrix.shape[0]
+        result = np.zeros((num_users, k), dtype=np.int64)
+        for start in range(0, num_users, block_size):
+            users = user_matrix[start:start + block_size]
+            if isinstance(users, CSRMatrix):
+                users = users.toarray()
+            users = np.asarray(users, dtype=float)
+            scores = (self.normalized @ self.profiles(users).T).T
+            result[start:start + len(users)] = top_k_rows(scores, users, k)
+        return result
+
+
+class NeighborEngine:
+    """Item-item collaborative filtering over a precomputed neighbor table.
+
+    Instead of scoring the whole catalogue, every rated movie j only adds
+    user_ratings[j] * cos(i, j) to the movies i among its nearest neighbors,
+    see build_neighbor_table. With every movie as a neighbor this is the
+    ItemItemEngine score; fewer neighbors are faster but can miss movies
+    whose similarity to the rated ones is small.
+    """
+
+    def __init__(self, neighbors, scores, num_neighbors=None):
+        self.neighbors = neighbors
+        self.scores = scores
+        self.num_neighbors = neighbors.shape[1] if num_neighbors is None else num_neighbors
+
+    def score(self, user_ratings, num_neighbors=None):
+        """Return the approximate item-item score of every movie for the user,
+        using the first num_neighbors neighbors of each rated movie."""
+        num_neighbors = self.num_neighbors if num_neighbors is None else num_neighbors
+        user_ratings = np.asarray(user_ratings, dtype=float)
+        rated_index = np.flatnonzero(user_ratings)
+        neighbors = self.neighbors[rated_index, :num_neighbors]
+        weights = user_ratings[rated_index, None] * self.scores[rated_index, :num_neighbors]
+        return np.bincount(neighbors.ravel(), weights=weights.ravel(), minlength=len(user_ratings))
+
+    def recommend(self, user_ratings, k=10, num_neighbors=None):
+        """Return the indices of the top k unrated movies for the user."""
+        return top_k(self.score(user_ratings, num_neighbors), user_ratings, k)
+
+
+class BlockedEngine:
+    """Item-item collaborative filtering over a ratings matrix too large to
+    load, such as the memory-mapped ratings cache or a dense np.memmap.
+
+    The user's rated rows are read to build their profile, then the matrix is
+    streamed block_size rows at a time: each block is normalized and scored,
+    and its top k are merged into the running top k. Normalizing a row only
+    depends on that row, so the scores are those of ItemItemEngine, while
+    memory stays at one block however many movies there are.
+
+    With threshold set, every block is binarized at that threshold first, so
+    raw ratings can be used as they are stored.
+    """
+
+    def __init__(self, ratings_matrix, block_size=1024, threshold=None):
+        self.ratings = ratings_matrix
+        self.block_size = block_size
+        self.threshold = threshold
+
+    def normalize(self, rows):
+        """Return rows of the ratings matrix, binarized if needed and normalized."""
+        if not isinstance(rows, CSRMatrix):
+            rows = np.asarray(rows, dtype=float)
+        if self.threshold is not None:
+            rows = binarize(rows, self.threshold)
+        return normalize_rows(rows)
+
+    def blocks(self):
+        """Yield (start, normalized rows start to start + block_size)."""
+        for start in range(0, self.ratings.shape[0], self.block_size):
+            yield start, self.normalize(self.ratings[start:start + self.block_size])
+
+    def profile(self, user_ratings):
+        """Return the sum of the user's normalized rated rows, weighted by rating."""
+        user_ratings = np.asarray(user_ratings, dtype=float)
+        rated_index = np.flatnonzero(user_ratings)
+        profile = np.zeros(self.ratings.shape[1])
+        for start in range(0, len(rated_index), self.block_size):
+            rows = rated_index[start:start + self.block_size]
+            profile += user_ratings[rows] @ self.normalize(self.ratings[rows])
+        return profile
+
+    def score(self, user_ratings):
+        """Return the item-item score of every movie for the given user."""
+        profile = self.profile(user_ratings)
+        scores = np.zeros(self.ratings.shape[0])
+        for start, block in self.blocks():
+            scores[start:start + block.shape[0]] = block @ profile
+        return scores
+
+    def recommend(self, user_ratings, k=10):
+        """Return the indices of the top k unrated movies for the user."""
+        user_ratings = np.asarray(user_ratings)
+        profile = self.profile(user_ratings)
+        best = []
+        for start, block in self.blocks():
+            scores = block @ profile
+            top = top_k(scores, user_ratings[start:start + len(scores)], k)
+            # (score, index) tuples order like top_k: descending score, ties to the larger index
+            best = heapq.nlargest(k, best + [(scores[i], start + i) for i in top])
+        return [index for _, index in best]
+
+
+class FactorEngine:
+    """Latent factor collaborative filtering over the movie factors of
+    build_movie_factors.
+
+    A user is folded in as the factors w whose reconstruction factors @ w is
+    closest to their ratings in least squares, the same fit the factors were
+    trained with. Besides the num_factors x num_factors Gram matrix, whose
+    pseudo-inverse is computed once, only the rated movies contribute to the
+    normal equations. Scoring is then one (num_movies x num_factors) product.
+    """
+
+    def __init__(self, factors):
+        self.factors = factors
+        exact = np.asarray(factors, dtype=float)
+        self.gram_inverse = np.linalg.pinv(exact.T @ exact)
+
+    @property
+    def num_factors(self):
+        return self.factors.shape[1]
+
+    def fold_in(self, user_ratings):
+        """Return the factors of a user with the given ratings."""
+        user_ratings = np.asarray(user_ratings, dtype=float)
+        rated_index = np.flatnonzero(user_ratings)
+        projection = user_ratings[rated_index] @ self.factors[rated_index]
+        return self.gram_inverse @ projection
+
+    def score(self, user_ratings):
+        """Return the predicted rating of every movie for the given user."""
+        return self.factors @ self.fold_in(user_ratings).astype(self.factors.dtype)
+
+    def recommend(self, user_ratings, k=10):
+        """Return the indices of the top k unrated movies for the user."""
+        return top_k(self.score(user_ratings), user_ratings, k)
@@ -0,0 +1,75 @@
+"""
+Numpy arrays backed by multiprocessing.shared_memory blocks, so processes
+that do not fork from each other can share them by name without copying
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArray:
+    """A numpy array living in a named shared memory block.
+
+    The process that creates the array owns the block and unlinks it; other
+    processes attach to it by name, e.g. after receiving the SharedArray
+    through pickle, which only sends the name, shape and dtype.
+    """
+
+    def __init__(self, block, shape, dtype, owner):
+        self.block = block
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = owner
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=block.buf)
+        if not owner:
+            self.array.flags.writeable = False
+
+    @classmethod
+    def copy_of(cls, array):
+        """Create a shared block holding a copy of array."""
+        array = np.ascontiguousarray(array)
+        # Blocks cannot be empty
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = cls(block, array.shape, array.dtype, owner=True)
+        shared.array[...] = array
+        shared.array.flags.writeable = False
+        return shared
+
+    @classmethod
+    def attach(cls, name, shape, dtype):
+        """Attach to the block created by another process."""
+        try:
+            # Only the owner should unlink the block when it exits
+            block = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            block = shared_memory.SharedMemory(name=name)
+        return cls(block, shape, dtype, owner=False)
+
+    @property
+    def name(self):
+        return self.block.name
+
+    def close(self):
+        """Release this process's mapping, and unlink the block if it owns it.
+
+        Arrays viewing the block must not be used afterwards.
+        """
+        if self.owner:
+            try:
+                self.block.unlink()
+            except FileNotFoundError:
+                pass
+            self.owner = False
+        self.array = None
+        try:
+            self.block.close()
+        except BufferError:
+            # Arrays still view the block, the mapping goes away with them
+            pass
+
+    def __reduce__(self):
+        return SharedArray.attach, (self.name, self.shape, self.dtype.str)
+
+    def __repr__(self):
+        return '<SharedArray {} {} {}>'.format(self.name, self.shape, self.dtype)
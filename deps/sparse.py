@@ -0,0 +1,152 @@
+"""
+Minimal compressed sparse row (CSR) matrix used to hold the ratings data, so
+memory grows with the number of ratings instead of movies x users
+"""
+
+import numpy as np
+
+# Entries of the dense row chunks products with dense matrices go through
+MATMUL_CHUNK_SIZE = 1 << 20
+
+
+class CSRMatrix:
+    """A 2D matrix in compressed sparse row format.
+
+    The non-zero entries of row i are data[indptr[i]:indptr[i + 1]], in the
+    columns given by the same slice of indices. Only the operations the
+    recommender needs are supported: row indexing, row norms and scaling, and
+    products with dense vectors and matrices on either side.
+    """
+
+    # Make numpy defer to our reflected operators, e.g. `vector @ matrix`
+    __array_ufunc__ = None
+
+    ndim = 2
+
+    def __init__(self, data, indices, indptr, shape):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.shape = (int(shape[0]), int(shape[1]))
+        self._row_ids = None
+
+    @classmethod
+    def from_coo(cls, rows, cols, values, shape):
+        """Build a CSR matrix from (row, column, value) triples.
+
+        Repeated (row, column) pairs keep the last value, like assigning the
+        triples one by one into a dense matrix.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        values = np.asarray(values, dtype=float)
+
+        order = np.lexsort((cols, rows))
+        rows, cols, values = rows[order], cols[order], values[order]
+
+        if len(rows) > 0:
+            last = np.ones(len(rows), dtype=bool)
+            last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+            rows, cols, values = rows[last], cols[last], values[last]
+
+        indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=shape[0]), out=indptr[1:])
+        return cls(values, cols.astype(np.int32), indptr, shape)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.indices.nbytes + self.indptr.nbytes
+
+    def row_ids(self):
+        """Return the row index of every stored entry."""
+        if self._row_ids is None:
+            self._row_ids = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        return self._row_ids
+
+    def with_data(self, data):
+        """Return a matrix with the same sparsity pattern and new values."""
+        return CSRMatrix(data, self.indices, self.indptr, self.shape)
+
+    def toarray(self):
+        dense = np.zeros(self.shape, dtype=self.data.dtype)
+        dense[self.row_ids(), self.indices] = self.data
+        return dense
+
+    def transpose(self):
+        return CSRMatrix.from_coo(self.indices, self.row_ids(), self.data, self.shape[::-1])
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def row_norms(self):
+        """Return the L2 norm of every row."""
+        squares = np.bincount(self.row_ids(), weights=self.data ** 2, minlength=self.shape[0])
+        return np.sqrt(squares)
+
+    def scale_rows(self, factors):
+        """Return a copy with row i multiplied by factors[i]."""
+        return self.with_data(self.data * np.asarray(factors)[self.row_ids()])
+
+    def __getitem__(self, key):
+        # A single row comes back dense, like indexing a 2D numpy array
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += self.shape[0]
+            if not 0 <= key < self.shape[0]:
+                raise IndexError('row index {} is out of bounds for {} rows'.format(key, self.shape[0]))
+            row = np.zeros(self.shape[1], dtype=self.data.dtype)
+            start, end = self.indptr[key], self.indptr[key + 1]
+            row[self.indices[start:end]] = self.data[start:end]
+            return row
+
+        if isinstance(key, tuple):
+            raise TypeError('CSRMatrix only supports row indexing')
+
+        # Contiguous slices are views, which only read those rows of memory-mapped arrays
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(self.shape[0])
+            stop = max(start, stop)
+            begin, end = self.indptr[start], self.indptr[stop]
+            indptr = self.indptr[start:stop + 1] - begin
+            return CSRMatrix(self.data[begin:end], self.indices[begin:end], indptr, (stop - start, self.shape[1]))
+
+        # Other slices, index arrays and boolean masks select a subset of rows
+        rows = np.arange(self.shape[0])[key]
+        lengths = np.diff(self.indptr)[rows]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        positions = np.repeat(self.indptr[rows] - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return CSRMatrix(self.data[positions], self.indices[positions], indptr, (len(rows), self.shape[1]))
+
+    def __matmul__(self, other):
+        other = np.asarray(other)
+        if other.ndim == 1:
+            weights = self.data * other[self.indices]
+            return np.bincount(self.row_ids(), weights=weights, minlength=self.shape[0])
+
+        # Chunks of rows are made dense and multiplied with one matrix
+        # product each, so temporaries stay at about MATMUL_CHUNK_SIZE entries
+        result = np.zeros((self.shape[0], other.shape[1]), dtype=np.result_type(self.data, other))
+        chunk_rows = max(1, MATMUL_CHUNK_SIZE // max(self.shape[1], 1))
+        for start in range(0, self.shape[0], chunk_rows):
+            result[start:start + chunk_rows] = self[start:start + chunk_rows].toarray() @ other
+        return result
+
+    def __rmatmul__(self, other):
+        other = np.asarray(other)
+        if other.ndim == 1:
+            weights = self.data * other[self.row_ids()]
+            return np.bincount(self.indices, weights=weights, minlength=self.shape[1])
+        return (self.transpose() @ other.T).T
+
+    def __repr__(self):
+        return '<{}x{} CSRMatrix with {} stored entries>'.format(self.shape[0], self.shape[1], self.nnz)
@@ -0,0 +1,222 @@
+"""The read-only movie model shared by every chatbot and conversation.
+
+Loading the ratings matrix and the model bundle is the expensive part of
+starting a chatbot, and none of it changes while the chatbot talks to a user.
+MovieModel holds all of it, so a process can load it once and serve any
+number of conversations, each with its own chatbot.Session.
+
+With shared_memory, the ratings arrays live in multiprocessing.shared_memory
+blocks instead, and a pickled model only carries their names. Processes
+started with spawn then attach to the same arrays instead of copying them.
+"""
+import atexit
+import threading
+
+import movielens
+from deps import lib
+from deps import recommender
+from deps.shm import SharedArray
+from deps.sparse import CSRMatrix
+
+
+class MovieModel:
+    """Titles, ratings and sentiment data the chatbot reads but never changes.
+
+    Attributes:
+      titles: standardized [title, year, genres] entries, indexed by movie id
+      title_index, title_tree, title_array, title_matcher: lookup structures
+        over the titles, see movielens.build_bundle
+      sentiment: the stemmed sentiment lexicon, word -> 'pos' or 'neg'
+      sentiment_lexicon: the lexicon compiled to token ids
+      ratings: the binarized (num_movies x num_users) CSRMatrix of ratings
+      engine: the in-memory item-item recommendation engine over ratings,
+        built on first use when the model was loaded without it
+      neighbor_engine(): the engine over the precomputed neighbor table
+      factor_engine(): the engine over the precomputed movie factors
+      blocked_engine(): the item-item engine streamed from the memory-mapped
+        ratings cache
+      shared_arrays: the shared memory blocks backing ratings and engine,
+        by name, or None when they are ordinary arrays
+    """
+
+    # Guards the creation of the process-wide model
+    _shared_lock = threading.Lock()
+    _shared = None
+
+    def __init__(self, bundle, ratings, exact=True):
+        self.titles = bundle['titles']
+        self.title_index = bundle['title_index']
+        self.title_tree = bundle['title_tree']
+        self.title_array = bundle['title_array']
+        self.title_matcher = bundle['title_matcher']
+        self.sentiment = bundle['sentiment']
+        self.sentiment_lexicon = bundle['sentiment_lexicon']
+
+        # Words from the lexicon are likely to come up, so their stems are cached up front
+        lib.stem_cache.seed(bundle['lexicon_stems'])
+
+        self.ratings = ratings
+        # Without exact, the normalized copy of the ratings is only made if engine is used
+        self._engine = recommender.ItemItemEngine(ratings) if exact else None
+        self.shared_arrays = None
+        self._neighbor_engine = None
+        self._factor_engine = None
+        self._blocked_engine = None
+
+    @classmethod
+    def load(cls, shared_memory=False, exact=True):
+        """Load a new model from the data files and the model bundle.
+
+        With shared_memory, the ratings arrays are moved to shared memory
+        blocks that are unlinked when the process exits, see share().
+        Without exact, the in-memory item-item engine is not built, e.g. when
+        recommendations are streamed from blocked_engine() instead.
+        """
+        # This matrix has the following shape: num_movies x num_users
+        # The values stored in each row i and column j is the rating for
+        # movie i by user j. It is kept sparse since most entries are empty.
+        _, ratings = movielens.ratings(sparse=True)
+        model = cls(movielens.load_bundle(), recommender.binarize(ratings), exact)
+        if shared_memory:
+            model.share()
+            atexit.register(model.close)
+        return model
+
+    @classmethod
+    def shared(cls, shared_memory=False, exact=True):
+        """Return the model of this process, loading it on first use.
+
+        shared_memory and exact are passed on to load() by the call that
+        loads the model.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls.load(shared_memory, exact)
+            return cls._shared
+
+    @property
+    def engine(self):
+        with self._shared_lock:
+            if self._engine is None:
+                self._engine = recommender.ItemItemEngine(self.ratings)
+            return self._engine
+
+    def neighbor_engine(self):
+        """Return the engine over the memory-mapped neighbor table of the
+        ratings file, loading (and if needed building) the table on first use."""
+        with self._shared_lock:
+            if self._neighbor_engine is None:
+                self._neighbor_engine = recommender.NeighborEngine(*movielens.neighbor_table())
+            return self._neighbor_engine
+
+    def factor_engine(self):
+        """Return the engine over the memory-mapped movie factors of the
+        ratings file, loading (and if needed training) them on first use."""
+        with self._shared_lock:
+            if self._factor_engine is None:
+                self._factor_engine = recommender.FactorEngine(movielens.movie_factors())
+            return self._factor_engine
+
+    def blocked_engine(self):
+        """Return the engine streamed from the memory-mapped raw ratings of
+        the ratings file, binarized block by block like ratings."""
+        with self._shared_lock:
+            if self._blocked_engine is None:
+                _, ratings = movielens.ratings(sparse=True)
+                self._blocked_engine = recommender.BlockedEngine(ratings, threshold=2.5)
+            return self._blocked_engine
+
+    def share(self):
+        """Move the binarized ratings and the engine's normalized ratings, if
+        built, to shared memory blocks, which this process owns until close().
+
+        The two matrices have the same sparsity pattern, so they share the
+        indices, indptr and row index blocks.
+        """
+        if self.shared_arrays is not None:
+            return
+        arrays = {
+            'indices': self.ratings.indices,
+            'indptr': self.ratings.indptr,
+            'row_ids': self.ratings.row_ids(),
+            'ratings': self.ratings.data,
+        }
+        if self._engine is not None:
+            arrays['normalized'] = self._engine.normalized.data
+        self.shared_arrays = {key: SharedArray.copy_of(array) for key, array in arrays.items()}
+        self.use_shared_arrays(self.ratings.shape)
+
+    def use_shared_arrays(self, shape):
+        """Point ratings and engine at the arrays in shared_arrays."""
+        arrays = {key: shared.array for key, shared in self.shared_arrays.items()}
+        self.ratings = CSRMatrix(arrays['ratings'], arrays['indices'], arrays['indptr'], shape)
+        self.ratings._row_ids = arrays['row_ids']
+        self._engine = None
+        if 'normalized' in arrays:
+            normalized = self.ratings.with_data(arrays['normalized'])
+            normalized._row_ids = arrays['row_ids']
+            self._engine = recommender.ItemItemEngine.from_normalized(normalized)
+
+    def close(self):
+        """Release the shared memory blocks, unlinking them if this process
+        created them. The model must not be used afterwards."""
+        if self.shared_arrays is None:
+            return
+        self.ratings = self._engine = None
+        for shared in self.shared_arrays.values():
+            shared.close()
+        self.shared_arrays = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # The neighbor table, factors and raw ratings are memory-mapped again on first use instead of copied
+        state['_neighbor_engine'] = state['_factor_engine'] = state['_blocked_engine'] = None
+        if self.shared_arrays is not None:
+            # Only the names of the blocks are pickled, see use_shared_arrays
+            state['ratings_shape'] = self.ratings.shape
+            del state['ratings'], state['_engine']
+        return state
+
+    def __setstate__(self, state):
+        shape = state.pop('ratings_shape', None)
+        self.__dict__.update(state)
+        if self.shared_arrays is not None:
+            self.use_shared_arrays(shape)
+
+    def arrays(self):
+        """Yield every numpy array the model holds."""
+        matrices = [self.ratings] if self._engine is None else [self.ratings, self._engine.normalized]
+        for matrix in matrices:
+            yield from (matrix.data, matrix.indices, matrix.indptr, matrix.row_ids())
+        yield self.title_array
+        yield self.title_matcher.num_words
+        yield from self.title_matcher.by_word.values()
+        lexicon = self.sentiment_lexicon
+        yield from (lexicon.polarity, lexicon.negation, lexicon.reset)
+        if self._neighbor_engine is not None:
+            yield from (self._neighbor_engine.neighbors, self._neighbor_engine.scores)
+        if self._factor_engine is not None:
+            yield from (self._factor_engine.factors, self._factor_engine.gram_inverse)
+        if self._blocked_engine is not None:
+            # Not row_ids(), which would hold an index of every raw rating in memory
+            raw = self._blocked_engine.ratings
+            yield from (raw.data, raw.indices, raw.indptr)
+
+    def freeze(self):
+        """Make the model's arrays read-only, e.g. before forking workers.
+
+        Lazily computed arrays of the ratings are built first, so workers
+        never write to the pages they share with the parent, and any attempt
+        to modify an array in place raises instead of silently copying it.
+        The neighbor, factor, blocked and in-memory item-item engines are only
+        included once loaded, so load the ones the workers use first.
+        """
+        for array in self.arrays():
+            array.flags.writeable = False
+
+    @property
+    def num_movies(self):
+        return len(self.titles)
+
+    def __repr__(self):
+        return '<MovieModel with {} movies and {!r}>'.format(self.num_movies, self.ratings)
@@ -4,11 +4,24 @@ Ported to Python 3 by Matt Mistele (@mmistele) and Sam Redmond (@sredmond).
 
 Intended for PA6 in Stanford's Winter 2019 CS124.
 """
+import argparse
 import csv
+import hashlib
+import io
+import json
+import logging
+import os
 import pathlib
+import pickle
 
 import numpy as np
 
+from deps import lib
+from deps import recommender
+from deps.sparse import CSRMatrix
+
+logger = logging.getLogger(__name__)
+
 ME = pathlib.Path(__file__).parent
 
 DATA_FOLDER = ME / 'data'
@@ -16,28 +29,269 @@ DATA_FOLDER = ME / 'data'
 RATINGS_FILE = str(DATA_FOLDER / 'ratings.txt')
 MOVIES_FILE = str(DATA_FOLDER / 'movies.txt')
 SENTIMENT_FILE = str(DATA_FOLDER / 'sentiment.txt')
+BUNDLE_FILE = str(DATA_FOLDER / 'model.bundle')
+
+# Bytes of the ratings file parsed at a time
+RATINGS_CHUNK_SIZE = 1 << 24
+
+# Bump when the layout of the binary ratings cache changes
+RATINGS_CACHE_VERSION = 1
+RATINGS_CACHE_ARRAYS = ('data', 'indices', 'indptr')
+
+# Bump when the layout of the neighbor table changes
+NEIGHBORS_VERSION = 1
+NEIGHBORS_ARRAYS = ('neighbors', 'scores')
+
+# Neighbors kept per movie in the neighbor table
+NUM_NEIGHBORS = 100
+
+# Code whose output is stored in the neighbor table
+NEIGHBORS_CODE_FILES = (str(ME / 'deps' / 'recommender.py'),)
+
+# Bump when the layout of the movie factors changes
+FACTORS_VERSION = 1
+FACTORS_ARRAYS = ('factors',)
+
+# Latent factors per movie
+NUM_FACTORS = 64
+
+# Code whose output is stored in the movie factors
+FACTORS_CODE_FILES = (str(ME / 'deps' / 'recommender.py'),)
+
+# Bump when the contents of the model bundle change
+BUNDLE_VERSION = 7
+
+# Code whose output is stored in the model bundle
+BUNDLE_CODE_FILES = (str(ME / 'deps' / 'lib.py'), str(ME / 'PorterStemmer.py'))
+
+
+def parse_ratings(src_filename=RATINGS_FILE, delimiter='%', header=False, chunk_size=RATINGS_CHUNK_SIZE):
+    """Parse a ratings file into numpy arrays in a single pass.
+
+    Each line of the file is `user_id<delimiter>movie_id<delimiter>rating`.
+    The file is read in chunks of chunk_size bytes, cut at the last complete
+    line, and every chunk is parsed by numpy straight into arrays.
+
+    :returns: (user_ids, movie_ids, values) as int32, int32 and float64 arrays
+    """
+    user_chunks, movie_chunks, value_chunks = [], [], []
+
+    def parse_chunk(chunk):
+        if not chunk.strip():
+            return
+        fields = np.loadtxt(io.BytesIO(chunk), delimiter=delimiter, comments=None, ndmin=2)
+        if fields.shape[1] != 3:
+            raise ValueError('Expected 3 fields per line in {}, found {}'.format(src_filename, fields.shape[1]))
+        user_chunks.append(fields[:, 0].astype(np.int32))
+        movie_chunks.append(fields[:, 1].astype(np.int32))
+        value_chunks.append(fields[:, 2])
+
+    with open(src_filename, 'rb') as f:
+        if header:
+            f.readline()
+
+        leftover = b''
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            block = leftover + block
+            end = block.rfind(b'\n') + 1
+            leftover = block[end:]
+            parse_chunk(block[:end])
+        parse_chunk(leftover)
+
+    if not user_chunks:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0)
+    return np.concatenate(user_chunks), np.concatenate(movie_chunks), np.concatenate(value_chunks)
+
+
+def file_signature(src_filename):
+    """Return the size, modification time and content hash of a file."""
+    stat = os.stat(src_filename)
+    digest = hashlib.blake2b()
+    with open(src_filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest.hexdigest()}
+
+
+def ratings_cache_dir(src_filename):
+    """Return the directory of the binary cache kept next to a ratings file."""
+    return src_filename + '.cache'
+
+
+def load_array_cache(cache_dir, names, expected_header):
+    """Memory-map the arrays of a binary cache directory.
+
+    Returns (arrays, header) with the arrays by name and the stored header,
+    or None when there is no cache, or when its header without 'shape' does
+    not match expected_header, e.g. because the size, modification time or
+    contents of the source file changed since the cache was written.
+    """
+    try:
+        with open(os.path.join(cache_dir, 'header.json')) as f:
+            header = json.load(f)
+        if {key: value for key, value in header.items() if key != 'shape'} != expected_header:
+            return None
+        arrays = {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r') for name in names}
+    except (OSError, KeyError, ValueError):
+        return None
+    return arrays, header
+
+
+def save_array_cache(cache_dir, arrays, header):
+    """Write arrays, a dict of name -> numpy array, to a binary cache directory.
+
+    The header is removed first and written last, so an interrupted write
+    leaves a cache that fails validation instead of a mismatched one.
+    """
+    header_file = os.path.join(cache_dir, 'header.json')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(header_file):
+            os.remove(header_file)
+        for name, array in arrays.items():
+            tmp_file = os.path.join(cache_dir, name + '.tmp.npy')
+            np.save(tmp_file, array)
+            os.replace(tmp_file, os.path.join(cache_dir, name + '.npy'))
+        with open(header_file + '.tmp', 'w') as f:
+            json.dump(header, f)
+        os.replace(header_file + '.tmp', header_file)
+    except OSError as e:
+        logger.warning('Could not write cache %s: %s', cache_dir, e)
+
+
+def load_ratings_cache(src_filename, expected_header):
+    """Memory-map the cached ratings matrix of src_filename, or return None
+    when the cache is missing or stale, see load_array_cache."""
+    cached = load_array_cache(ratings_cache_dir(src_filename), RATINGS_CACHE_ARRAYS, expected_header)
+    if cached is None:
+        return None
+    arrays, header = cached
+    try:
+        return CSRMatrix(arrays['data'], arrays['indices'], arrays['indptr'], header['shape'])
+    except (KeyError, TypeError, IndexError):
+        return None
+
+
+def save_ratings_cache(src_filename, matrix, header):
+    """Write the sparse ratings matrix of src_filename to its binary cache."""
+    arrays = {name: getattr(matrix, name) for name in RATINGS_CACHE_ARRAYS}
+    save_array_cache(ratings_cache_dir(src_filename), arrays, header)
+
+
+def ratings(src_filename=RATINGS_FILE, delimiter='%', header=False, quoting=csv.QUOTE_MINIMAL, sparse=False, cache=True):
+    """Load the (num_movies x num_users) ratings matrix.
+
+    There is one row per movie in the titles file, and the number of users is
+    inferred from the largest user id in the ratings. The fields of the ratings
+    file are all numeric, so quoting is accepted for compatibility but unused.
 
+    With sparse=True the matrix is returned as a CSRMatrix that only stores the
+    ratings that exist, instead of a dense matrix that is mostly zeros.
 
-def ratings(src_filename=RATINGS_FILE, delimiter='%', header=False, quoting=csv.QUOTE_MINIMAL):
+    With cache=True the parsed matrix is saved in a binary sidecar directory
+    next to src_filename, and later loads memory-map it instead of parsing the
+    text again. The sidecar is rebuilt whenever the source file changes.
+    """
     title_list = titles()
-    user_id_set = set()
-    with open(src_filename, 'r') as f:
-        content = f.readlines()
-        for line in content:
-            user_id = int(line.split(delimiter)[0])
-            if user_id not in user_id_set:
-                user_id_set.add(user_id)
-    num_users = len(user_id_set)
     num_movies = len(title_list)
-    mat = np.zeros((num_movies, num_users))
 
-    with open(src_filename) as f:
-        reader = csv.reader(f, delimiter=delimiter, quoting=quoting)
-        if header:
-            next(reader)
-        for line in reader:
-            mat[int(line[1])][int(line[0])] = float(line[2])
-    return title_list, mat
+    matrix = None
+    if cache:
+        cache_header = {
+            'version': RATINGS_CACHE_VERSION,
+            'source': file_signature(src_filename),
+            'delimiter': delimiter,
+            'header': header,
+            'num_movies': num_movies,
+        }
+        matrix = load_ratings_cache(src_filename, cache_header)
+
+    if matrix is None:
+        user_ids, movie_ids, values = parse_ratings(src_filename, delimiter, header)
+        num_users = int(user_ids.max()) + 1 if len(user_ids) > 0 else 0
+        matrix = CSRMatrix.from_coo(movie_ids, user_ids, values, (num_movies, num_users))
+        if cache:
+            save_ratings_cache(src_filename, matrix, dict(cache_header, shape=list(matrix.shape)))
+
+    if sparse:
+        return title_list, matrix
+    return title_list, matrix.toarray()
+
+
+def neighbors_cache_dir(src_filename):
+    """Return the directory of the neighbor table kept next to a ratings file."""
+    return src_filename + '.neighbors.cache'
+
+
+def neighbor_table(src_filename=RATINGS_FILE, num_neighbors=NUM_NEIGHBORS, build=True):
+    """Load the item-item neighbor table of a ratings file.
+
+    For every movie, the table holds the num_neighbors movies with the most
+    cosine-similar binarized ratings, see recommender.build_neighbor_table.
+    The arrays are memory-mapped from a cache next to the ratings file. When
+    the cache is missing or stale it is rebuilt, unless build is False.
+
+    :returns: (neighbors, scores), int32 and float32 arrays of shape
+      (num_movies, num_neighbors), or None when there is no table and build is False
+    """
+    cache_dir = neighbors_cache_dir(src_filename)
+    header = {
+        'version': NEIGHBORS_VERSION,
+        'source': file_signature(src_filename),
+        'code': [file_signature(code_file)['hash'] for code_file in NEIGHBORS_CODE_FILES],
+        'num_neighbors': num_neighbors,
+    }
+    cached = load_array_cache(cache_dir, NEIGHBORS_ARRAYS, header)
+    if cached is not None:
+        arrays, _ = cached
+        return arrays['neighbors'], arrays['scores']
+    if not build:
+        return None
+
+    _, matrix = ratings(src_filename, sparse=True)
+    normalized = recommender.normalize_rows(recommender.binarize(matrix))
+    table = recommender.build_neighbor_table(normalized, num_neighbors)
+    save_array_cache(cache_dir, dict(zip(NEIGHBORS_ARRAYS, table)), header)
+    return table
+
+
+def factors_cache_dir(src_filename):
+    """Return the directory of the movie factors kept next to a ratings file."""
+    return src_filename + '.factors.cache'
+
+
+def movie_factors(src_filename=RATINGS_FILE, num_factors=NUM_FACTORS, build=True):
+    """Load the latent factors of every movie in a ratings file.
+
+    The factors are trained on the binarized ratings, see
+    recommender.build_movie_factors. Like the neighbor table, they are
+    memory-mapped from a cache next to the ratings file, which is rebuilt
+    when missing or stale unless build is False.
+
+    :returns: a float32 array of shape (num_movies, num_factors), or None
+      when there are no factors and build is False
+    """
+    cache_dir = factors_cache_dir(src_filename)
+    header = {
+        'version': FACTORS_VERSION,
+        'source': file_signature(src_filename),
+        'code': [file_signature(code_file)['hash'] for code_file in FACTORS_CODE_FILES],
+        'num_factors': num_factors,
+    }
+    cached = load_array_cache(cache_dir, FACTORS_ARRAYS, header)
+    if cached is not None:
+        arrays, _ = cached
+        return arrays['factors']
+    if not build:
+        return None
+
+    _, matrix = ratings(src_filename, sparse=True)
+    factors = recommender.build_movie_factors(recommender.binarize(matrix), num_factors)
+    save_array_cache(cache_dir, {'factors': factors}, header)
+    return factors
 
 
 def titles(src_filename=MOVIES_FILE, delimiter='%', header=False, quoting=csv.QUOTE_MINIMAL):
@@ -61,3 +315,92 @@ def sentiment(src_filename=SENTIMENT_FILE, delimiter=',', header=False, quoting=
         if header:
             next(reader)  # Skip the first line.
         return dict(reader)
+
+
+def bundle_header(movies_filename=MOVIES_FILE, sentiment_filename=SENTIMENT_FILE):
+    """Return the header that identifies an up to date model bundle."""
+    return {
+        'version': BUNDLE_VERSION,
+        'titles': file_signature(movies_filename),
+        'sentiment': file_signature(sentiment_filename),
+        'code': [file_signature(code_file)['hash'] for code_file in BUNDLE_CODE_FILES],
+    }
+
+
+def build_bundle(bundle_filename=BUNDLE_FILE, movies_filename=MOVIES_FILE, sentiment_filename=SENTIMENT_FILE):
+    """Precompute the chatbot's derived data and write it to a model bundle.
+
+    The bundle holds the standardized titles, the title index, the BK-tree and
+    the numpy array of lowercased titles used for spell correction, the word
+    matcher used for quoteless title extraction, the stemmed sentiment lexicon
+    with its compiled token-id form and the stem of every lexicon word, so the
+    chatbot does not redo that work every time it starts.
+
+    :returns: the bundle as a dict
+    """
+    header = bundle_header(movies_filename, sentiment_filename)
+    standardized_titles = lib.standardize_titles(titles(movies_filename))
+    lexicon = sentiment(sentiment_filename)
+    lexicon_words = {word for key in lexicon for word in lib.alpha_words(key.lower())}
+    stemmed_lexicon = lib.stem_map(lexicon)
+    bundle = {
+        'titles': standardized_titles,
+        'title_index': lib.TitleIndex(standardized_titles),
+        'title_tree': lib.BKTree((title.lower(), i) for i, (title, _, _) in enumerate(standardized_titles)),
+        'title_array': np.array([title.lower() for title, _, _ in standardized_titles]),
+        'title_matcher': lib.TitleWordMatcher(standardized_titles),
+        'sentiment': stemmed_lexicon,
+        'sentiment_lexicon': lib.SentimentLexicon(stemmed_lexicon),
+        'lexicon_stems': {word: lib.stem_cache.stem(word) for word in lexicon_words},
+    }
+
+    # The header is pickled first so staleness checks can skip the payload
+    tmp_filename = bundle_filename + '.tmp'
+    try:
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, bundle_filename)
+    except OSError as e:
+        logger.warning('Could not write model bundle %s: %s', bundle_filename, e)
+    return bundle
+
+
+def load_bundle(bundle_filename=BUNDLE_FILE, movies_filename=MOVIES_FILE, sentiment_filename=SENTIMENT_FILE):
+    """Load the model bundle, rebuilding it first if it is missing or stale.
+
+    The bundle is stale when the titles or sentiment file, the code that
+    derives the bundle, or BUNDLE_VERSION changed since it was built.
+
+    :returns: the bundle as a dict
+    """
+    header = bundle_header(movies_filename, sentiment_filename)
+    try:
+        with open(bundle_filename, 'rb') as f:
+            if pickle.load(f) == header:
+                return pickle.load(f)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    logger.info('Rebuilding model bundle %s', bundle_filename)
+    return build_bundle(bundle_filename, movies_filename, sentiment_filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds the precompiled data files used by the chatbot.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Write the model bundle, the binary ratings cache, the neighbor table and the movie factors')
+    build_parser.add_argument('--neighbors', type=int, default=NUM_NEIGHBORS, help='Neighbors kept per movie')
+    build_parser.add_argument('--factors', type=int, default=NUM_FACTORS, help='Latent factors per movie')
+    args = parser.parse_args()
+
+    build_bundle()
+    ratings(sparse=True)
+    neighbor_table(num_neighbors=args.neighbors)
+    movie_factors(num_factors=args.factors)
+    print('Wrote {}, {}, {} and {}'.format(BUNDLE_FILE, ratings_cache_dir(RATINGS_FILE),
+                                           neighbors_cache_dir(RATINGS_FILE), factors_cache_dir(RATINGS_FILE)))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,7 @@ logger = logging.getLogger(__name__)
 # Uncomment me to see which REPL commands are being run!
 # logger.setLevel(logging.DEBUG)
 
+import chatbot as chatbot_module
 from chatbot import Chatbot
 
 # Modular ASCII font from http://patorjk.com/software/taag/
@@ -130,7 +131,9 @@ class REPL(cmd.Cmd):
 def process_command_line():
   parser = argparse.ArgumentParser(description=pa6_description)
   parser.add_argument('--creative', dest='creative', action='store_true', default=False, help='Enables creative mode')
+  parser.add_argument('--engine', choices=chatbot_module.RECOMMEND_ENGINES, default=chatbot_module.RECOMMEND_ENGINE, help='How recommendations are scored')
   args = parser.parse_args()
+  chatbot_module.RECOMMEND_ENGINE = args.engine
   return args
 
 
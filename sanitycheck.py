@@ -7,12 +7,26 @@
 #   python sanity_check.py --recommender
 #   python sanity_check.py --binarize
 ######################################################################
+import chatbot as chatbot_module
 from chatbot import Chatbot
+from deps import lib
+from deps import recommender
+from model import MovieModel
+import movielens
+import server
 
 
 import argparse
+import asyncio
+import json
 import numpy as np
 import math
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import tracemalloc
 
 
 def assertNumpyArrayEquals(givenValue, correctValue, failureMessage):
@@ -50,6 +64,342 @@ def assertEquals(givenValue, correctValue, failureMessage):
         print("Actual: {}".format(givenValue))
         return False
 
+def test_neighbor_engine():
+    print("Testing recommendations from a full neighbor table...")
+    chatbot = Chatbot(False)
+
+    # With every other movie as a neighbor, the table scores like the exact engine
+    normalized = chatbot.engine.normalized[np.arange(400)]
+    exact = recommender.ItemItemEngine.from_normalized(normalized)
+    neighbors = recommender.NeighborEngine(*recommender.build_neighbor_table(normalized, 399, block_size=128))
+
+    rng = np.random.RandomState(0)
+    for _ in range(5):
+        user_ratings = np.zeros(400)
+        user_ratings[rng.choice(400, 10, replace=False)] = rng.choice([-1, 1], 10)
+        if not assertListEquals(
+            neighbors.recommend(user_ratings, 10),
+            exact.recommend(user_ratings, 10),
+            "Incorrect recommendations from the neighbor table"
+        ):
+            print()
+            return False
+
+    print('neighbor engine sanity check passed!')
+    print()
+    return True
+
+def test_incremental_scores():
+    print("Testing session scores updated one rating at a time...")
+    chatbot = Chatbot(False)
+    session = chatbot.new_session()
+    # Sessions only allocate the scores once the exact engine scores them
+    if not assertEquals(
+        [session.scores, session.scored_ratings],
+        [None, None],
+        "Incorrect running scores of a new session"
+    ):
+        print()
+        return False
+
+    rng = np.random.RandomState(0)
+    for movie in rng.choice(len(chatbot.titles), 30, replace=False):
+        session.user_ratings[movie] = rng.choice([-1, 1])
+        chatbot.update_scores(session)
+    # Change some ratings, and rate one without updating the scores
+    session.user_ratings[np.flatnonzero(session.user_ratings)[:5]] *= -1
+    chatbot.update_scores(session)
+    session.user_ratings[rng.randint(len(chatbot.titles))] = 1
+
+    if assertListEquals(
+        chatbot.recommend_session(session, 10),
+        chatbot.recommend(session.user_ratings, chatbot.ratings, 10),
+        "Incorrect recommendations from the session's running scores"
+    ):
+        # Clearing a rating leaves exactly the scores of the remaining ones
+        session.user_ratings[np.flatnonzero(session.user_ratings)[0]] = 0
+        chatbot.update_scores(session)
+        if assertEquals(
+            np.array_equal(session.scores, chatbot.engine.score(session.user_ratings)),
+            True,
+            "Incorrect running scores after clearing a rating"
+        ):
+            print('incremental scores sanity check passed!')
+    print()
+
+def test_recommendation_cursor():
+    print("Testing recommendations paged from a cursor...")
+    chatbot = Chatbot(False)
+    session = chatbot.new_session()
+
+    rng = np.random.RandomState(0)
+    session.user_ratings[rng.choice(len(chatbot.titles), 10, replace=False)] = rng.choice([-1, 1], 10)
+    expected = chatbot.recommend_session(session, 35)
+    cursor = chatbot.recommendation_cursor(session, page_size=10)
+    paged = [cursor.next() for _ in range(5)]
+    # Ratings made while paging do not change the cursor's recommendations
+    session.user_ratings[expected[-1]] = 1
+    chatbot.update_scores(session)
+    paged += [cursor.next() for _ in range(30)]
+
+    # Paging continues the order of a single top k, without repeats
+    if not assertListEquals(
+        paged,
+        expected,
+        "Incorrect recommendations paged from the cursor"
+    ):
+        print()
+        return False
+
+    # Every unrated movie is recommended once, then the cursor runs out
+    cursor = recommender.RecommendationCursor(np.array([0.5, 2, 1, 2, 3]), np.array([0, 0, 1, 0, 0]), page_size=2)
+    if assertListEquals(
+        [cursor.next() for _ in range(6)] + [cursor.count],
+        [4, 3, 1, 0, None, None, 4],
+        "Incorrect recommendations from an exhausted cursor"
+    ):
+        print('recommendation cursor sanity check passed!')
+    print()
+
+def test_recommend_batch():
+    print("Testing recommendations for a batch of users...")
+    chatbot = Chatbot(False)
+
+    user_matrix = chatbot.ratings.T[np.arange(100)]
+    expected = [chatbot.recommend(user_matrix[u], chatbot.ratings, 10) for u in range(100)]
+    for block_size in (1, 32, 256):
+        if not assertListEquals(
+            chatbot.recommend_batch(user_matrix, 10, block_size=block_size).tolist(),
+            expected,
+            "Incorrect recommendations for a batch of users with block_size={}".format(block_size)
+        ):
+            print()
+            return False
+
+    # Memory follows the block size, the ratings are never made dense
+    memory_cap = chatbot.ratings.shape[0] * chatbot.ratings.shape[1] * 8 // 2
+    tracemalloc.start()
+    try:
+        chatbot.recommend_batch(user_matrix, 10, block_size=32)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    if peak > memory_cap:
+        print("recommend_batch used too much memory")
+        print("Expected: at most {} bytes".format(memory_cap))
+        print("Actual: {} bytes".format(peak))
+        print()
+        return False
+
+    # Tied scores go to the larger index, and missing recommendations are -1
+    ratings_matrix = np.array([
+        [1, 1, 0],
+        [1, 1, 0],
+        [0, 0, 1],
+        [1, 1, 0],
+    ])
+    user_matrix = np.array([
+        [1, 0, 0, 0],
+        [1, 1, 1, 0],
+        [1, 1, 1, 1],
+    ])
+    if assertListEquals(
+        chatbot.recommend_batch(user_matrix, 2, ratings_matrix).tolist(),
+        [[3, 1], [3, -1], [-1, -1]],
+        "Incorrect recommendations for a batch of users with ties"
+    ):
+        print('recommend_batch sanity check passed!')
+    print()
+
+def test_blocked_engine():
+    print("Testing recommendations streamed from the memory-mapped ratings...")
+    chatbot = Chatbot(False)
+    # The raw ratings, memory-mapped from the ratings cache
+    _, ratings = movielens.ratings(sparse=True)
+    engine = recommender.BlockedEngine(ratings, block_size=128, threshold=2.5)
+    # Loading the whole matrix takes at least this much, streaming it should not
+    memory_cap = ratings.nbytes // 2
+
+    rng = np.random.RandomState(0)
+    for _ in range(5):
+        user_ratings = np.zeros(len(chatbot.titles), dtype=np.int8)
+        user_ratings[rng.choice(len(chatbot.titles), 20, replace=False)] = rng.choice([-1, 1], 20)
+
+        tracemalloc.start()
+        try:
+            recommendations = engine.recommend(user_ratings, 10)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        if peak > memory_cap:
+            print("Streaming recommendations used too much memory")
+            print("Expected: at most {} bytes".format(memory_cap))
+            print("Actual: {} bytes".format(peak))
+            print()
+            return False
+        if not assertListEquals(
+            recommendations,
+            chatbot.engine.recommend(user_ratings, 10),
+            "Incorrect recommendations streamed from the memory-mapped ratings"
+        ):
+            print()
+            return False
+
+    # Selected in the chatbot, the model never builds the in-memory engine
+    model = MovieModel.load(exact=False)
+    blocked_chatbot = Chatbot(False, model=model)
+    session = blocked_chatbot.new_session()
+    session.user_ratings[rng.choice(len(chatbot.titles), 10, replace=False)] = rng.choice([-1, 1], 10)
+    recommend_engine = chatbot_module.RECOMMEND_ENGINE
+    chatbot_module.RECOMMEND_ENGINE = 'blocked'
+    try:
+        recommendations = [
+            blocked_chatbot.recommend(session.user_ratings, blocked_chatbot.ratings, 10),
+            blocked_chatbot.recommend_session(session, 10),
+        ]
+    finally:
+        chatbot_module.RECOMMEND_ENGINE = recommend_engine
+    if not assertListEquals(
+        recommendations,
+        [chatbot.engine.recommend(session.user_ratings, 10)] * 2,
+        "Incorrect recommendations from the blocked engine"
+    ) or not assertEquals(
+        model._engine,
+        None,
+        "The blocked engine built the in-memory item-item engine"
+    ):
+        print()
+        return False
+
+    print('blocked engine sanity check passed!')
+    print()
+    return True
+
+def test_factor_engine():
+    print("Testing recommendations from latent movie factors...")
+    # Ratings of rank 3 are reconstructed from 3 factors
+    rng = np.random.RandomState(0)
+    ratings = rng.standard_normal((200, 3)) @ rng.standard_normal((3, 50))
+    engine = recommender.FactorEngine(recommender.build_movie_factors(ratings, 3))
+    if not np.allclose(engine.score(ratings[:, 7]), ratings[:, 7], atol=1e-3):
+        print("Incorrect ratings reconstructed from movie factors")
+        print()
+        return False
+
+    chatbot = Chatbot(False)
+    session = chatbot.new_session()
+    session.user_ratings[rng.choice(len(chatbot.titles), 10, replace=False)] = rng.choice([-1, 1], 10)
+    engine = chatbot.model.factor_engine()
+    if engine.factors.dtype != np.float32:
+        print("Movie factors should be float32, not {}".format(engine.factors.dtype))
+        print()
+        return False
+
+    recommend_engine = chatbot_module.RECOMMEND_ENGINE
+    chatbot_module.RECOMMEND_ENGINE = 'factors'
+    try:
+        if assertListEquals(
+            [chatbot.recommend(session.user_ratings, chatbot.ratings, 10), chatbot.recommend_session(session, 10)],
+            [engine.recommend(session.user_ratings, 10)] * 2,
+            "Incorrect recommendations from the factors engine"
+        ):
+            print('factor engine sanity check passed!')
+    finally:
+        chatbot_module.RECOMMEND_ENGINE = recommend_engine
+    print()
+
+def test_sparse_ratings():
+    print("Testing sparse ratings matrix...")
+    chatbot = Chatbot(False)
+
+    _, dense = movielens.ratings()
+    _, sparse = movielens.ratings(sparse=True)
+    if not assertNumpyArrayEquals(sparse.toarray(), dense, "Sparse and dense ratings loaders disagree."):
+        print()
+        return False
+
+    if not assertNumpyArrayEquals(
+        chatbot.binarize(sparse).toarray(),
+        chatbot.binarize(dense),
+        "Incorrect output for binarize() on a sparse ratings matrix."
+    ):
+        print()
+        return False
+
+    user_ratings = np.zeros(dense.shape[0])
+    user_ratings[[0, 1, 10, 1359, 2716]] = [1, -1, 1, 1, -1]
+    if not assertListEquals(
+        chatbot.recommend(user_ratings, chatbot.binarize(sparse)),
+        chatbot.recommend(user_ratings, chatbot.binarize(dense)),
+        "recommend() gives different results for sparse and dense ratings."
+    ):
+        print()
+        return False
+
+    print("sparse ratings sanity check passed!")
+    print()
+    return True
+
+def test_ratings_cache():
+    print("Testing binary ratings cache...")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src_filename = os.path.join(tmp_dir, 'ratings.txt')
+        shutil.copy(movielens.RATINGS_FILE, src_filename)
+
+        _, parsed = movielens.ratings(src_filename, sparse=True)
+        _, cached = movielens.ratings(src_filename, sparse=True)
+        if not (assertEquals(isinstance(cached.data, np.memmap), True, "Second load did not memory-map the cache.")
+                and assertNumpyArrayEquals(cached.toarray(), parsed.toarray(), "Cached ratings differ from the parsed ratings.")):
+            print()
+            return False
+
+        # Same size and modification time, different contents
+        stat = os.stat(src_filename)
+        with open(src_filename, 'r+') as f:
+            f.write('0%30%1.5')
+        os.utime(src_filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        _, changed = movielens.ratings(src_filename, sparse=True)
+        if not assertEquals(changed[30][0], 1.5, "Cache was not invalidated when the ratings file changed."):
+            print()
+            return False
+
+        with open(src_filename, 'a') as f:
+            f.write('\n671%1%4.0\n')
+        _, appended = movielens.ratings(src_filename, sparse=True)
+        if not assertEquals(appended.shape[1], cached.shape[1] + 1, "Cache was not invalidated when a rating was added."):
+            print()
+            return False
+
+    print("ratings cache sanity check passed!")
+    print()
+    return True
+
+def test_model_bundle():
+    print("Testing model bundle...")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bundle_filename = os.path.join(tmp_dir, 'model.bundle')
+        sentiment_filename = os.path.join(tmp_dir, 'sentiment.txt')
+        shutil.copy(movielens.SENTIMENT_FILE, sentiment_filename)
+
+        bundle = movielens.load_bundle(bundle_filename, sentiment_filename=sentiment_filename)
+        if not (assertEquals(os.path.exists(bundle_filename), True, "Missing model bundle was not built.")
+                and assertListEquals(bundle['titles'], lib.standardize_titles(movielens.titles()), "Bundle titles are not standardized.")
+                and assertEquals(bundle['sentiment'], lib.stem_map(movielens.sentiment()), "Bundle lexicon is not stemmed.")):
+            print()
+            return False
+
+        with open(sentiment_filename, 'a') as f:
+            f.write('marvelous,pos\n')
+        bundle = movielens.load_bundle(bundle_filename, sentiment_filename=sentiment_filename)
+        if not assertEquals(bundle['sentiment'].get('marvel'), 'pos', "Stale model bundle was not rebuilt."):
+            print()
+            return False
+
+    print("model bundle sanity check passed!")
+    print()
+    return True
+
 def test_similarity():
     print("Testing similarity() functionality...")
     chatbot = Chatbot(False)
@@ -149,6 +499,204 @@ def test_extract_titles_creative():
 
     """ """
 
+def reference_quoteless_titles(chatbot, text):
+    """The original quoteless extraction loop of extract_titles() over the whole catalogue."""
+    titles = []
+    for title, year, _ in chatbot.titles:
+        title_with_year = title + ' ({})'.format(year)
+        if lib.extract_title_by_word(title_with_year.lower(), text.lower()):
+            return [title_with_year]
+        elif lib.extract_title_by_word(title.lower(), text.lower()):
+            titles = [t for t in titles if t.lower() not in title.lower()]
+            if not any(title.lower() in t.lower() for t in titles):
+                titles.append(title)
+    return titles
+
+def test_extract_titles_quoteless_matcher():
+    print("Testing quoteless extract_titles() against a catalogue scan...")
+    chatbot = Chatbot(True)
+
+    texts = ['I liked the notebook', 'No movies here!', 'I liked 10, things i hate about you.',
+             'Titanic (1997), started out terrible, but the ending was totally great and I loved it!']
+    for title, year, _ in chatbot.titles[::409]:
+        texts += ['I really liked {} a lot.'.format(title.lower()), 'Have you seen {} ({})?'.format(title, year)]
+
+    for text in texts:
+        if not assertListEquals(
+            chatbot.extract_titles(text),
+            reference_quoteless_titles(chatbot, text),
+            "Incorrect output for extract_titles('{}')".format(text)
+        ):
+            print()
+            return False
+
+    print('quoteless extract_titles() sanity check passed!')
+    print()
+    return True
+
+def test_process_analyzes_once():
+    print("Testing that process() scans and stems each line once...")
+    chatbot = Chatbot(True)
+
+    calls = {'scan_titles': 0, 'stem_text': 0}
+    scan_titles, stem_text = chatbot.scan_titles, lib.stem_text
+    def counting_scan_titles(utterance):
+        calls['scan_titles'] += 1
+        return scan_titles(utterance)
+    def counting_stem_text(text):
+        calls['stem_text'] += 1
+        return stem_text(text)
+
+    chatbot.scan_titles = counting_scan_titles
+    lib.stem_text = counting_stem_text
+    try:
+        chatbot.process('I really loved the notebook!')
+    finally:
+        lib.stem_text = stem_text
+
+    if assertEquals(
+        calls,
+        {'scan_titles': 1, 'stem_text': 1},
+        "Incorrect number of title scans and stemming passes for one line"
+    ):
+        print('process() analysis sanity check passed!')
+        print()
+        return True
+    print()
+    return False
+
+def test_sessions():
+    print("Testing conversations in separate sessions...")
+    chatbot = Chatbot(False)
+    first, second = chatbot.new_session(), chatbot.new_session()
+
+    chatbot.process_session(first, 'I loved "Titanic (1997)"')
+    chatbot.process_session(second, 'I hated "Avatar"')
+    chatbot.process_session(first, 'I hated "Avatar"')
+
+    if assertEquals(
+        Chatbot(True).model is chatbot.model,
+        True,
+        "Chatbots do not share the same MovieModel"
+    ) and assertEquals(
+        (np.count_nonzero(first.user_ratings), np.count_nonzero(second.user_ratings), np.count_nonzero(chatbot.user_ratings)),
+        (2, 1, 0),
+        "Incorrect number of rated movies in each session"
+    ) and assertEquals(
+        second.user_ratings[chatbot.find_movies_by_title('Avatar')[0]],
+        -1,
+        "Incorrect rating in the second session"
+    ):
+        print('sessions sanity check passed!')
+    print()
+
+def test_frozen_model():
+    print("Testing a frozen model...")
+    chatbot = Chatbot(False)
+    frozen = MovieModel.load()
+    frozen.freeze()
+
+    user_ratings = np.zeros(frozen.num_movies)
+    user_ratings[[0, 10, 20, 30, 40]] = [1, -1, 1, 1, -1]
+    if assertEquals(
+        [array.flags.writeable for array in frozen.arrays()].count(True),
+        0,
+        "Some arrays of a frozen model are still writeable"
+    ) and assertListEquals(
+        Chatbot(False, model=frozen).recommend(user_ratings, frozen.ratings),
+        chatbot.recommend(user_ratings, chatbot.ratings),
+        "Incorrect recommendations from a frozen model"
+    ):
+        print('frozen model sanity check passed!')
+    print()
+
+# The model of a spawned test_shared_memory_model worker
+worker_model = None
+
+def init_worker_model(model):
+    global worker_model
+    worker_model = model
+
+def worker_recommend(user_ratings):
+    return worker_model.engine.recommend(user_ratings, 10), worker_model.ratings.data.flags.writeable
+
+def test_shared_memory_model():
+    print("Testing a model in shared memory with spawned workers...")
+    chatbot = Chatbot(False)
+    model = MovieModel.load(shared_memory=True)
+    names = [shared.name for shared in model.shared_arrays.values()]
+
+    rng = np.random.RandomState(0)
+    users = np.zeros((4, model.num_movies))
+    for user_ratings in users:
+        user_ratings[rng.choice(model.num_movies, 8, replace=False)] = rng.choice([-1, 1], 8)
+
+    with multiprocessing.get_context('spawn').Pool(2, initializer=init_worker_model, initargs=(model,)) as pool:
+        results = pool.map(worker_recommend, users)
+    # A chatbot over the model pickles the ratings by name too, not by value
+    pickled_sizes = [len(pickle.dumps(model)), len(pickle.dumps(Chatbot(False, model=model)))]
+    model.close()
+
+    if assertListEquals(
+        [recommendations for recommendations, _ in results],
+        [chatbot.recommend(user_ratings, chatbot.ratings) for user_ratings in users],
+        "Incorrect recommendations from a spawned worker"
+    ) and assertListEquals(
+        [writeable for _, writeable in results],
+        [False] * len(users),
+        "Workers can write to the shared ratings"
+    ) and assertListEquals(
+        [name for name in names if os.path.exists(os.path.join('/dev/shm', name))],
+        [],
+        "Shared memory blocks were not unlinked by close()"
+    ) and assertEquals(
+        pickled_sizes[1] < pickled_sizes[0] + model.num_movies * 64,
+        True,
+        "Incorrect pickled size of a chatbot over a shared memory model: {} bytes for a {} byte model".format(*reversed(pickled_sizes))
+    ):
+        print('shared memory model sanity check passed!')
+    print()
+
+def test_server():
+    print("Testing conversations over the server...")
+
+    async def converse(port, lines):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        replies = [json.loads(await reader.readline())]
+        for line in lines:
+            writer.write(line.encode() + b'\n')
+            await writer.drain()
+            replies.append(json.loads(await reader.readline()))
+        writer.close()
+        await writer.wait_closed()
+        return replies
+
+    async def run():
+        chat_server = server.ChatServer(Chatbot(False))
+        listener = await chat_server.start('127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        async with listener:
+            replies = await asyncio.gather(
+                converse(port, ['{"line": "I loved \\"Titanic (1997)\\""}', 'not json', '{"line": ":quit"}']),
+                converse(port, ['{"line": "I hated \\"Avatar\\""}', '{"line": "recommend"}']),
+            )
+            # Let the handlers finish before the listener and the loop shut down
+            await chat_server.wait_connections_closed()
+            return replies
+
+    first, second = asyncio.run(run())
+    if assertEquals(
+        [sorted(reply) for reply in first],
+        [['response'], ['response'], ['error'], ['response']],
+        "Incorrect replies to the first connection"
+    ) and assertEquals(
+        second[2]['response'].startswith('You need to rate at least 5 movies'),
+        True,
+        "Incorrect reply to recommend in the second connection, sessions are not separate"
+    ):
+        print('server sanity check passed!')
+    print()
+
 def test_find_movies_by_title():
     print("Testing find_movies_by_title() functionality...")
     chatbot = Chatbot(False)
@@ -259,6 +807,60 @@ def test_extract_sentiment():
     print()
 
 
+def test_extract_sentiment_batch():
+    print("Testing extract_sentiment_batch() against extract_sentiment()...")
+    chatbot = Chatbot(False)
+
+    texts = ["I like \"Titanic (1997)\".", "I saw \"Titanic (1997)\".", "I didn't enjoy \"Titanic (1997)\".",
+             "I never liked \"Avatar\", it was not great, but fun.", "It wasn't bad. I don't love it, however it is nice",
+             "terrible awful bad good", "Not good. Not bad! Loved it", "", "\"Good Will Hunting\" was not good"]
+    rng = np.random.RandomState(0)
+    words = list(chatbot.sentiment)[:300] + ['not', 'never', 'but', 'however', 'it.', 'so,', 'the', 'was']
+    texts += [' '.join(rng.choice(words, rng.randint(1, 20))) for _ in range(200)]
+
+    expected = [chatbot.extract_sentiment(text) for text in texts]
+    if assertListEquals(
+        list(chatbot.extract_sentiment_batch(texts)),
+        expected,
+        "Incorrect output for extract_sentiment_batch()"
+    ) and assertListEquals(
+        list(chatbot.extract_sentiment_batch(iter(texts), chunk_size=7)),
+        expected,
+        "Incorrect output for extract_sentiment_batch() with chunk_size=7"
+    ) and assertListEquals(
+        list(chatbot.extract_sentiment_batch(texts, chunk_size=50, processes=2)),
+        expected,
+        "Incorrect output for extract_sentiment_batch() with processes=2"
+    ):
+        read = []
+        def endless():
+            while True:
+                read.append(None)
+                yield texts[len(read) % len(texts)]
+        results = chatbot.extract_sentiment_batch(endless(), chunk_size=10, processes=2)
+        next(results)
+        results.close()
+        if len(read) > 10 * 2 * chatbot_module.SENTIMENT_CHUNKS_PER_PROCESS:
+            print("Incorrect read-ahead for extract_sentiment_batch() with processes=2: read {} texts".format(len(read)))
+            return
+        print('extract_sentiment_batch() sanity check passed!')
+    print()
+
+def test_tokenize_conj_movie_other():
+    print("Testing tokenize_conj_movie_other() functionality...")
+    if assertListEquals(
+        lib.tokenize_conj_movie_other('I liked "I, Robot" and "" but not "Ex Machina" or Up and'),
+        [(lib.TKN_OTHER, 'I liked'), (lib.TKN_TITLE, 'I, Robot'), (lib.TKN_CONJ, 'and'), (lib.TKN_CONJ, 'but'),
+         (lib.TKN_OTHER, 'not'), (lib.TKN_TITLE, 'Ex Machina'), (lib.TKN_CONJ, 'or'), (lib.TKN_OTHER, 'Up'), (lib.TKN_CONJ, 'and')],
+        "Incorrect output for tokenize_conj_movie_other()"
+    ) and assertListEquals(
+        list(lib.iter_conj_movie_other('"Titanic" and "Avatar')),
+        [(lib.TKN_TITLE, 'Titanic'), (lib.TKN_CONJ, 'and'), (lib.TKN_TITLE, 'Avatar')],
+        "Incorrect output for iter_conj_movie_other() with an unclosed quote"
+    ):
+        print('tokenize_conj_movie_other() sanity check passed!')
+    print()
+
 def test_extract_sentiment_for_movies():
     print("Testing test_extract_sentiment_for_movies() functionality...")
     chatbot = Chatbot(True)
@@ -297,6 +899,46 @@ def test_extract_sentiment_for_movies():
         print('extract_sentiment_for_movies() sanity check passed!')
     print()
 
+def reference_find_movies_by_title(chatbot, title):
+    """The original linear scan of find_movies_by_title() without spell correction."""
+    movie_title, movie_year = lib.extract_year_from_title(title)
+    movie_title = lib.move_leading_article_to_front(movie_title)
+    movies = []
+    for i, (entry_title, entry_year, _) in enumerate(chatbot.titles):
+        if movie_year is not None and movie_year != entry_year:
+            continue
+        if chatbot.creative:
+            if lib.title_contains_words(movie_title, entry_title) and not chatbot.quoteless_title_extraction:
+                movies.append(i)
+            elif movie_title.lower() == entry_title.lower():
+                movies.append(i)
+        elif movie_title == entry_title:
+            movies.append(i)
+    return movies
+
+def test_find_movies_by_title_index():
+    print("Testing find_movies_by_title() against a linear scan...")
+    queries = ["Titanic", "SCREAM", "2", "10", "The", "Love", "Gojira", "Las Vampiras", "Phantom Love", "Alive & Kicking", "Up!"]
+    for entry_title, entry_year, _ in Chatbot(False).titles[::293]:
+        words = entry_title.split()
+        queries += [entry_title, entry_title.upper(), '{} ({})'.format(entry_title, entry_year),
+                    words[0], ' '.join(words[-2:]) + '.', lib.move_leading_article_to_end(entry_title)]
+
+    for chatbot, quoteless in [(Chatbot(False), False), (Chatbot(True), False), (Chatbot(True), True)]:
+        chatbot.quoteless_title_extraction = quoteless
+        for query in queries:
+            if not assertListEquals(
+                chatbot.find_movies_by_title(query),
+                reference_find_movies_by_title(chatbot, query),
+                "Incorrect output for find_movies_by_title('{}') with creative={}, quoteless={}".format(query, chatbot.creative, quoteless)
+            ):
+                print()
+                return False
+
+    print('find_movies_by_title() index sanity check passed!')
+    print()
+    return True
+
 def test_find_movies_closest_to_title():
     print("Testing find_movies_closest_to_title() functionality...")
     chatbot = Chatbot(True)
@@ -312,6 +954,33 @@ def test_find_movies_closest_to_title():
     print()
     return True
 
+def test_find_movies_closest_to_title_search():
+    print("Testing find_movies_closest_to_title() searches agree...")
+    chatbot = Chatbot(True)
+
+    for misspelled in ["Sleeping Beaty", "Harry Poter", "Titanik (1997)"]:
+        results = {}
+        for search in ['scan', 'bktree', 'batch']:
+            chatbot_module.SPELL_SEARCH = search
+            results[search] = chatbot.find_movies_closest_to_title(misspelled, max_distance=3)
+        chatbot_module.SPELL_SEARCH = 'bktree'
+
+        if not (assertListEquals(
+            results['bktree'],
+            results['scan'],
+            "BK-tree and linear scan disagree for find_movies_closest_to_title('{}', max_distance=3)".format(misspelled)
+        ) and assertListEquals(
+            results['batch'],
+            results['scan'],
+            "Batched and linear scan disagree for find_movies_closest_to_title('{}', max_distance=3)".format(misspelled)
+        )):
+            print()
+            return False
+
+    print('find_movies_closest_to_title() search sanity check passed!')
+    print()
+    return True
+
 def test_disambiguate():
     print("Testing disambiguate() functionality...")
     chatbot = Chatbot(True)
@@ -387,6 +1056,41 @@ def test_recommend():
         print("recommend() sanity check passed!")
     print()
 
+def reference_recommend(chatbot, user_ratings, ratings_matrix, k=10):
+    """The original pairwise item-item loop, kept to check the vectorized engine against."""
+    recommendations = []
+    rated_index = np.where(user_ratings != 0)[0]
+    for i in np.where(user_ratings == 0)[0]:
+        score = 0
+        for j in rated_index:
+            score += user_ratings[j] * chatbot.similarity(ratings_matrix[i], ratings_matrix[j])
+        recommendations.append((score, i))
+    return [elem[1] for elem in sorted(recommendations)[::-1][:k]]
+
+def test_recommend_equivalence():
+    print("Testing recommend() against the pairwise loop...")
+    chatbot = Chatbot(False)
+
+    # A slice of the real catalogue keeps the reference loop quick
+    ratings_matrix = chatbot.ratings[:1500]
+    rng = np.random.RandomState(124)
+    for trial in range(3):
+        user_ratings = np.zeros(ratings_matrix.shape[0])
+        rated = rng.choice(ratings_matrix.shape[0], 5 + 5 * trial, replace=False)
+        user_ratings[rated] = rng.choice([-1, 1], len(rated))
+
+        if not assertListEquals(
+            chatbot.recommend(user_ratings, ratings_matrix, k=10),
+            reference_recommend(chatbot, user_ratings, ratings_matrix, k=10),
+            "recommend() and the pairwise loop disagree for user ratings at {}".format(sorted(rated))
+        ):
+            print()
+            return False
+
+    print("recommend() equivalence check passed!")
+    print()
+    return True
+
 def test_arbitrary_response():
     print("Testing generate_arbitrary_response() functionality...")
     chatbot = Chatbot(True)
@@ -462,17 +1166,37 @@ def main():
     test_extract_titles()
     test_find_movies_by_title()
     test_extract_sentiment()
+    test_extract_sentiment_batch()
     test_recommend()
+    test_recommend_equivalence()
+    test_neighbor_engine()
+    test_incremental_scores()
+    test_recommendation_cursor()
+    test_recommend_batch()
+    test_blocked_engine()
+    test_factor_engine()
     test_binarize()
     test_similarity()
+    test_sparse_ratings()
+    test_ratings_cache()
+    test_model_bundle()
+    test_sessions()
+    test_frozen_model()
+    test_shared_memory_model()
+    test_server()
     #test_process()
 
     if testing_creative:
         test_find_movies_by_title_creative()
+        test_find_movies_by_title_index()
         test_find_movies_closest_to_title()
+        test_find_movies_closest_to_title_search()
+        test_tokenize_conj_movie_other()
         test_extract_sentiment_for_movies()
         test_disambiguate()
         test_extract_titles_creative()
+        test_extract_titles_quoteless_matcher()
+        test_process_analyzes_once()
         #test_process_creative()
 
 if __name__ == '__main__':
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+# PA6, CS124, Stanford, Winter 2019
+# v.1.0.3
+#
+# Usage:
+#   python server.py --port 8124 --creative
+#   python server.py --workers 8 --memory-report 60
+#   python server.py --engine factors
+#
+# Serves the chatbot to many users at once over TCP. Every connection is its
+# own conversation, and all of them share the one model loaded by the process.
+# With --workers, the model is loaded once and that many worker processes are
+# forked to share it copy-on-write, all accepting on the same socket.
+#
+# Protocol: one JSON object per line in each direction.
+#   client: {"line": "I liked \"Titanic (1997)\""}
+#   server: {"response": "You liked \"Titanic (1997)\"? Good choice!"}
+# The server greets every new connection with a response, answers malformed
+# requests with {"error": "..."}, and says goodbye and closes the connection
+# when the line is ":quit".
+######################################################################
+import argparse
+import asyncio
+import concurrent.futures
+import gc
+import json
+import logging
+import os
+import signal
+import socket
+import time
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+import chatbot as chatbot_module
+from chatbot import Chatbot
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8124
+
+# Longest request line accepted, in bytes
+MAX_LINE_LENGTH = 1 << 16
+
+server_description = 'Line-delimited JSON server that holds many conversations with one chatbot'
+
+class ChatServer:
+    """Runs one conversation per TCP connection on a shared chatbot.
+
+    The event loop only reads and writes lines. Each line is processed on the
+    executor, so a slow recommendation or spell correction for one user does
+    not stall the others. A connection's lines are processed one at a time, in
+    order, so its Session is never used by two threads at once.
+    """
+
+    def __init__(self, chatbot, executor=None):
+      self.chatbot = chatbot
+      self.executor = executor
+      self.num_connections = 0
+      # Set whenever there are no open connections
+      self.all_closed = asyncio.Event()
+      self.all_closed.set()
+
+    async def handle_connection(self, reader, writer):
+      peer = writer.get_extra_info('peername')
+      session = self.chatbot.new_session()
+      self.num_connections += 1
+      self.all_closed.clear()
+      logger.debug('%s connected, %d open connections', peer, self.num_connections)
+
+      try:
+        await self.send(writer, {'response': self.chatbot.greeting()})
+        while True:
+          try:
+            data = await reader.readline()
+          except ValueError:
+            await self.send(writer, {'error': 'line longer than {} bytes'.format(MAX_LINE_LENGTH)})
+            break
+          if not data:
+            break
+
+          try:
+            line = json.loads(data)['line']
+            if not isinstance(line, str):
+              raise TypeError(line)
+          except (ValueError, KeyError, TypeError):
+            await self.send(writer, {'error': 'expected a JSON object with a "line" string'})
+            continue
+
+          if line == ':quit':
+            await self.send(writer, {'response': self.chatbot.goodbye()})
+            break
+
+          try:
+            response = await self.process(session, line)
+          except Exception:
+            logger.exception('Failed to process %r from %s', line, peer)
+            await self.send(writer, {'error': 'internal error'})
+            continue
+          await self.send(writer, {'response': response})
+      except ConnectionError:
+        logger.debug('%s dropped the connection', peer)
+      finally:
+        writer.close()
+        try:
+          await writer.wait_closed()
+        except ConnectionError:
+          pass
+        self.num_connections -= 1
+        if self.num_connections == 0:
+          self.all_closed.set()
+
+    async def process(self, session, line):
+      loop = asyncio.get_running_loop()
+      return await loop.run_in_executor(self.executor, self.chatbot.process_session, session, line)
+
+    async def send(self, writer, message):
+      writer.write(json.dumps(message).encode() + b'\n')
+      await writer.drain()
+
+    async def wait_connections_closed(self):
+      """Wait until every connection has been closed by its handler."""
+      await self.all_closed.wait()
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, sock=None):
+      """Start listening, on sock if given, and return the asyncio server."""
+      if sock is not None:
+        return await asyncio.start_server(self.handle_connection, sock=sock, limit=MAX_LINE_LENGTH)
+      return await asyncio.start_server(self.handle_connection, host, port, limit=MAX_LINE_LENGTH)
+
+
+async def serve(chatbot, args, sock=None):
+  with concurrent.futures.ThreadPoolExecutor(args.threads) as executor:
+    server = await ChatServer(chatbot, executor).start(args.host, args.port, sock)
+    if sock is None:
+      for listening in server.sockets:
+        print('{} listening on {}'.format(chatbot.name, listening.getsockname()))
+    async with server:
+      await server.serve_forever()
+
+
+def memory_usage(pid='self'):
+  """Return the memory of a process in kB, from /proc/<pid>/smaps_rollup (Linux only).
+
+  'unique' is the memory no other process shares (private clean + private
+  dirty pages), the cost of one more worker. 'proportional' splits each
+  shared page between the processes mapping it, and 'resident' counts shared
+  pages in full.
+  """
+  fields = {}
+  with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+    for line in f:
+      parts = line.split()
+      if len(parts) == 3 and parts[2] == 'kB':
+        fields[parts[0].rstrip(':')] = int(parts[1])
+  return {
+    'resident': fields['Rss'],
+    'proportional': fields['Pss'],
+    'unique': fields['Private_Clean'] + fields['Private_Dirty'],
+  }
+
+def print_memory_report(pids):
+  print('{:>8} {:>14} {:>14} {:>14}'.format('pid', 'unique kB', 'pss kB', 'rss kB'))
+  for pid in [os.getpid()] + pids:
+    try:
+      usage = memory_usage(pid)
+    except (OSError, KeyError) as e:
+      print('{:>8} unavailable: {}'.format(pid, e))
+      continue
+    label = '{} (parent)'.format(pid) if pid == os.getpid() else pid
+    print('{:>8} {:>14,} {:>14,} {:>14,}'.format(label, usage['unique'], usage['proportional'], usage['resident']))
+
+def serve_prefork(chatbot, args):
+  """Serve from args.workers forked processes sharing the parent's model.
+
+  The model is loaded before forking and frozen, so its numpy buffers stay
+  shared copy-on-write. gc.freeze() keeps the collector from writing to the
+  headers of the objects loaded so far, which would copy their pages too.
+  """
+  # Load the selected engine's table now, so workers share it instead of
+  # each building or loading their own on the first recommendation
+  if chatbot_module.RECOMMEND_ENGINE == 'neighbors':
+    chatbot.model.neighbor_engine()
+  elif chatbot_module.RECOMMEND_ENGINE == 'factors':
+    chatbot.model.factor_engine()
+  elif chatbot_module.RECOMMEND_ENGINE == 'blocked':
+    chatbot.model.blocked_engine()
+  chatbot.model.freeze()
+  sock = socket.create_server((args.host, args.port), reuse_port=False)
+  sock.setblocking(False)
+  print('{} listening on {} with {} workers'.format(chatbot.name, sock.getsockname(), args.workers))
+
+  gc.collect()
+  gc.freeze()
+
+  pids = []
+  for _ in range(args.workers):
+    pid = os.fork()
+    if pid == 0:
+      # Worker: let the parent decide when to stop
+      signal.signal(signal.SIGINT, signal.SIG_IGN)
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      status = 0
+      try:
+        asyncio.run(serve(chatbot, args, sock))
+      except BaseException:
+        logger.exception('Worker %d failed', os.getpid())
+        status = 1
+      finally:
+        os._exit(status)
+    pids.append(pid)
+
+  def stop(signum, frame):
+    for pid in pids:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except ProcessLookupError:
+        pass
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+
+  # Wait for the workers, reporting their memory every args.memory_report seconds
+  next_report = time.monotonic() + args.memory_report if args.memory_report else None
+  while pids:
+    if next_report is not None and time.monotonic() >= next_report:
+      print_memory_report(pids)
+      next_report += args.memory_report
+    pid, _ = os.waitpid(-1, os.WNOHANG) if next_report is not None else os.waitpid(-1, 0)
+    if pid:
+      pids.remove(pid)
+    elif next_report is not None:
+      time.sleep(min(1, max(0, next_report - time.monotonic())))
+  sock.close()
+
+
+def process_command_line():
+  parser = argparse.ArgumentParser(description=server_description)
+  parser.add_argument('--host', default=DEFAULT_HOST, help='Address to listen on')
+  parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+  parser.add_argument('--threads', type=int, default=None, help='Threads processing lines, defaults to the executor default')
+  parser.add_argument('--workers', type=int, default=0, help='Fork this many worker processes sharing one loaded model')
+  parser.add_argument('--memory-report', type=float, default=0, help='With --workers, print per-worker memory every this many seconds')
+  parser.add_argument('--creative', dest='creative', action='store_true', default=False, help='Enables creative mode')
+  parser.add_argument('--engine', choices=chatbot_module.RECOMMEND_ENGINES, default=chatbot_module.RECOMMEND_ENGINE, help='How recommendations are scored')
+  parser.add_argument('--debug', action='store_true', help='Log connections')
+  args = parser.parse_args()
+  chatbot_module.RECOMMEND_ENGINE = args.engine
+  if args.debug:
+    logger.setLevel(logging.DEBUG)
+  return args
+
+
+if __name__ == '__main__':
+  args = process_command_line()
+  chatbot = Chatbot(creative=args.creative)
+  if args.workers > 0:
+    serve_prefork(chatbot, args)
+  else:
+    try:
+      asyncio.run(serve(chatbot, args))
+    except KeyboardInterrupt:
+      pass